@@ -8,9 +8,18 @@ import traceback
 import base64
 import re
 import shutil
+import random
+import sqlite3
+import heapq
+import uuid
+import itertools
+import hashlib
+import ntpath
 from datetime import datetime, timedelta, timezone
 from html import escape
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
 # Telegram Bot Library Imports
 from telegram import Update, InputFile, ReplyKeyboardMarkup, ReplyKeyboardRemove
@@ -20,6 +29,7 @@ from telegram.ext import (
     MessageHandler,
     filters,
     CallbackContext,
+    ChatMemberHandler,
     ContextTypes,
 )
 from telegram.constants import ParseMode
@@ -32,25 +42,72 @@ TOKEN = "8405925930:AAFEIfylx6AuqP5TgkwKCtN7iXd39D_kMSg"
 # API Configuration
 API_BASE_URL = "https://garenagwt.vercel.app/token"
 API_KEY = "narayan"
+GITHUB_API_URL = "https://api.github.com"
+
+# HTTP Connection Pool Settings (one shared pool per upstream host)
+HTTP_CONNECTIONS_PER_HOST = 50
+HTTP_KEEPALIVE_TIMEOUT = 60  # Seconds an idle connection is kept open for reuse
+HTTP_DNS_CACHE_TTL = 300
 
 # Bot Settings
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB (Telegram's bot download limit)
+RESULTS_TO_DISK_THRESHOLD = 2 * 1024 * 1024  # Uploads larger than this stream their results to disk as they complete
 ADMIN_ID = 5943766669
-MAX_CONCURRENT_REQUESTS = 10
+MAX_CONCURRENT_REQUESTS = 10  # Starting upstream concurrency; adapted at runtime between the bounds below
+MIN_GLOBAL_CONCURRENT_REQUESTS = 2
+MAX_GLOBAL_CONCURRENT_REQUESTS = 30  # Hard cap across all manual and scheduled jobs, shared fairly between users
+API_LATENCY_TARGET_P95 = 10.0  # Seconds; concurrency only grows while p95 upstream latency stays below this
+API_MAX_RETRIES = 3  # Extra attempts per account for timeouts, dropped connections, 429 and 502/503/504
+API_RETRY_BASE_DELAY = 1.0  # Seconds; backoff is a random delay up to base * 2^attempt
+API_RETRY_MAX_DELAY = 20.0
+API_RETRY_BUDGET_RATIO = 0.1  # Retries allowed per batch, as a fraction of the batch's accounts
+API_RETRY_BUDGET_MIN = 10
+RETRYABLE_API_STATUSES = {429, 502, 503, 504}
+API_BREAKER_FAILURE_THRESHOLD = 8  # Consecutive transient failures before the token API circuit opens
+API_BREAKER_RECOVERY_TIMEOUT = 30  # Seconds the circuit stays open before a single probe request is let through
+TOKEN_CACHE_MAX_ENTRIES = 100000  # Least recently used tokens are dropped beyond this
+TOKEN_CACHE_MIN_REMAINING = 1800  # Seconds a cached JWT must still be valid for to be reused instead of calling the API
+ACCOUNT_WORKERS_PER_JOB = 40  # Accounts one job keeps in flight (waiting for or holding an API slot, or backing off)
+MAX_CONCURRENT_MANUAL_JOBS = 3  # Uploaded files processed at the same time; further uploads wait in the job queue
+MAX_QUEUED_MANUAL_JOBS = 100
+JSON_STREAM_CHUNK_SIZE = 64 * 1024  # Characters read per step when streaming account files
+JSON_STREAM_MAX_ITEM_SIZE = 1024 * 1024  # Largest single account object accepted from a streamed file
 ADMIN_CONTACT_LINK = 'https://t.me/atxabir'
-AUTO_PROCESS_CHECK_INTERVAL = 60
+AUTO_PROCESS_CHECK_INTERVAL = 60  # Seconds before a due schedule that couldn't start (user left the channel, run crashed) is tried again
+SCHEDULER_MAX_SLEEP = 3600  # Upper bound on how long the scheduler sleeps waiting for the next due schedule
+SCHEDULE_JITTER_MAX = 300  # Max seconds a schedule's runs are offset by its fixed per-schedule jitter...
+SCHEDULE_JITTER_RATIO = 0.1  # ...and never more than this fraction of its interval
+SCHEDULE_ACCOUNTS_PER_WINDOW = 20000  # Accounts scheduled runs may start per SCHEDULE_DISPATCH_WINDOW; bigger runs wait for a full window
+SCHEDULE_DISPATCH_WINDOW = 60
+SCHEDULE_DEFER_DELAY = 15  # Seconds a non-urgent run is pushed back while calls are queueing for the token API
+SCHEDULE_MAX_DEFER_RATIO = 0.25  # A run this late (as a fraction of its interval) is urgent and starts without waiting
+SCHEDULE_INCREMENTAL_RUNS = True  # Scheduled runs reuse tokens from the previous run that outlive the next one; only expiring or failed accounts hit the API
+GITHUB_SKIP_UNCHANGED_UPLOADS = True  # Don't commit a token file whose tokens match the last upload to the same repo/branch/file
+MAX_ROTATION_FILES = 20  # Files per rotation schedule; each tick processes the next one
+ROTATION_KEY_PREFIX = '@'  # Marks rotations in the scheduler index; sanitized /setfile names can't contain it
+STATE_FLUSH_INTERVAL = 5  # Max seconds a state change waits in memory before being written to disk
+KNOWN_USERS_COMPACT_THRESHOLD = 10000  # Journal records before known users are compacted into a snapshot
+VIP_EXPIRY_CHECK_MAX_SLEEP = 3600  # Upper bound on how long the VIP expiry watcher sleeps between checks
+VIP_EXPIRY_NOTIFY_MAX_AGE = 7 * 86400  # Expiries missed (e.g. while the bot was down) are still notified if no older than this
+STORAGE_BACKEND = "json"  # "json" (files in DATA_DIR) or "sqlite" (SQLITE_DB_FILE, migrated from the JSON files on first start)
 CHANNEL_USERNAME = "atxnaughty"
+CHANNEL_MEMBER_CACHE_TTL = 300  # Seconds a positive channel membership check is trusted
+CHANNEL_NON_MEMBER_CACHE_TTL = 30  # Seconds a negative check is trusted, so users who just joined aren't locked out for long
 
 # --- File Paths ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, 'bot_data')
 TEMP_DIR = os.path.join(DATA_DIR, 'temp_files')
 SCHEDULED_FILES_DATA_DIR = os.path.join(DATA_DIR, 'scheduled_files_data')
+JOBS_DIR = os.path.join(DATA_DIR, 'jobs')  # Checkpoints of in-flight batches, resumed after a restart
 
 VIP_FILE = os.path.join(DATA_DIR, 'vip_users.json')
 GITHUB_CONFIG_FILE = os.path.join(DATA_DIR, 'github_configs.json')
 KNOWN_USERS_FILE = os.path.join(DATA_DIR, 'known_users.json')
+KNOWN_USERS_JOURNAL = os.path.join(DATA_DIR, 'known_users.journal')
 SCHEDULED_FILES_CONFIG = os.path.join(DATA_DIR, 'scheduled_files.json')
+ROTATION_FILES_CONFIG = os.path.join(DATA_DIR, 'rotation_files.json')
+SQLITE_DB_FILE = os.path.join(DATA_DIR, 'bot_state.db')
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -174,32 +231,319 @@ def save_json_data(filepath: str, data: dict | list) -> bool:
             except OSError as e:
                 logger.warning(f"Could not remove temporary save file {temp_filepath}: {e}")
 
+# --- SQLite Storage Backend ---
+# When STORAGE_BACKEND is "sqlite", the state store persists to SQLite instead
+# of the JSON files. Every user is one row (or, for schedules, one row per
+# schedule) keyed by user_id. Savers name the users they changed, and a flush
+# serializes and rewrites only those users' rows.
+_sqlite_conn: sqlite3.Connection | None = None
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vip_users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS github_configs (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS scheduled_files (
+    user_id TEXT NOT NULL,
+    schedule_name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, schedule_name)
+);
+CREATE TABLE IF NOT EXISTS known_users (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def using_sqlite() -> bool:
+    """Returns True when state is persisted to the SQLite backend."""
+    return _sqlite_conn is not None
+
+def _sqlite_table_for(filepath: str) -> str | None:
+    """Maps a state file path to the SQLite table that stores it."""
+    return {
+        VIP_FILE: 'vip_users',
+        GITHUB_CONFIG_FILE: 'github_configs',
+        SCHEDULED_FILES_CONFIG: 'scheduled_files',
+    }.get(filepath)
+
+def _sqlite_user_rows(table: str, user_id_str: str, value) -> list[tuple]:
+    """Serializes one user's entry of a state dict into the rows stored for it."""
+    if table == 'scheduled_files':
+        if not isinstance(value, dict):
+            return []
+        return [(user_id_str, schedule_name, json.dumps(schedule_info, ensure_ascii=False)) for schedule_name, schedule_info in value.items()]
+    return [(user_id_str, json.dumps(value, ensure_ascii=False))]
+
+def _sqlite_load_table(table: str) -> dict:
+    """Loads a whole table back into the nested dict shape used by the JSON files."""
+    data = {}
+    if table == 'scheduled_files':
+        for user_id_str, schedule_name, raw in _sqlite_conn.execute("SELECT user_id, schedule_name, data FROM scheduled_files"):
+            data.setdefault(user_id_str, {})[schedule_name] = json.loads(raw)
+    else:
+        for user_id_str, raw in _sqlite_conn.execute(f"SELECT user_id, data FROM {table}"):
+            data[user_id_str] = json.loads(raw)
+    return data
+
+def _sqlite_sync_table(table: str, data: dict, user_ids: set[str] | None = None) -> bool:
+    """
+    Rewrites the rows of the given users (every user if user_ids is None) in one transaction;
+    users no longer in data lose their rows. Returns True on success.
+    """
+    if not isinstance(data, dict):
+        data = {}
+    if table == 'scheduled_files':
+        insert_sql = "INSERT OR REPLACE INTO scheduled_files (user_id, schedule_name, data) VALUES (?, ?, ?)"
+    else:
+        insert_sql = f"INSERT OR REPLACE INTO {table} (user_id, data) VALUES (?, ?)"
+    try:
+        with _sqlite_conn:
+            if user_ids is None:
+                _sqlite_conn.execute(f"DELETE FROM {table}")
+                user_ids = [str(user_id_str) for user_id_str in data]
+            else:
+                _sqlite_conn.executemany(f"DELETE FROM {table} WHERE user_id = ?", ((user_id_str,) for user_id_str in user_ids))
+            rows = [row for user_id_str in user_ids if user_id_str in data for row in _sqlite_user_rows(table, user_id_str, data[user_id_str])]
+            _sqlite_conn.executemany(insert_sql, rows)
+        logger.debug(f"SQLite: synced {table} ({len(user_ids)} user(s), {len(rows)} row(s) written).")
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error syncing table {table}: {e}")
+        return False
+
+def _sqlite_apply_known_user_records(records: list[str]) -> bool:
+    """Applies +id/-id known user records, in order, directly to the known_users table."""
+    try:
+        with _sqlite_conn:
+            for record in records:
+                uid = int(record[1:])
+                if record.startswith('+'):
+                    _sqlite_conn.execute("INSERT OR IGNORE INTO known_users (user_id) VALUES (?)", (uid,))
+                else:
+                    _sqlite_conn.execute("DELETE FROM known_users WHERE user_id = ?", (uid,))
+        logger.debug(f"SQLite: applied {len(records)} known user record(s).")
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error updating known users: {e}")
+        return False
+
+def _sqlite_replace_known_users(user_set: set) -> bool:
+    """Replaces the known_users table with the given set."""
+    try:
+        with _sqlite_conn:
+            _sqlite_conn.execute("DELETE FROM known_users")
+            _sqlite_conn.executemany("INSERT INTO known_users (user_id) VALUES (?)", ((uid,) for uid in user_set))
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error replacing known users: {e}")
+        return False
+
+def migrate_json_to_sqlite() -> None:
+    """One-shot import of the JSON state files into SQLite. Skipped once the database is marked migrated."""
+    if _sqlite_conn.execute("SELECT value FROM meta WHERE key = 'json_migrated_on'").fetchone():
+        return
+    logger.info("SQLite: migrating existing JSON state files into the database...")
+    for filepath in (VIP_FILE, GITHUB_CONFIG_FILE, SCHEDULED_FILES_CONFIG):
+        table = _sqlite_table_for(filepath)
+        data = load_json_data(filepath, {}) if os.path.exists(filepath) else {}
+        if not _sqlite_sync_table(table, data):
+            raise sqlite3.DatabaseError(f"Migration of {filepath} into table {table} failed.")
+        logger.info(f"SQLite: migrated {len(data)} user(s) from {os.path.basename(filepath)}.")
+
+    known_users = _parse_known_users(load_json_data(KNOWN_USERS_FILE, [])) if os.path.exists(KNOWN_USERS_FILE) else set()
+    _replay_known_users_journal(known_users)
+    if not _sqlite_replace_known_users(known_users):
+        raise sqlite3.DatabaseError("Migration of known users failed.")
+    logger.info(f"SQLite: migrated {len(known_users)} known user(s).")
+
+    with _sqlite_conn:
+        _sqlite_conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated_on', ?)", (datetime.now(timezone.utc).isoformat(),))
+    logger.info("SQLite: JSON migration complete. The JSON files are left in place as a backup.")
+
+def init_storage() -> None:
+    """Opens the configured storage backend. For SQLite this enables WAL mode and runs the one-shot migration."""
+    global _sqlite_conn
+    if STORAGE_BACKEND != "sqlite":
+        logger.info("Storage backend: JSON files.")
+        return
+    _sqlite_conn = sqlite3.connect(SQLITE_DB_FILE)
+    _sqlite_conn.execute("PRAGMA journal_mode=WAL")
+    _sqlite_conn.execute("PRAGMA synchronous=NORMAL")
+    _sqlite_conn.executescript(SQLITE_SCHEMA)
+    migrate_json_to_sqlite()
+    logger.info(f"Storage backend: SQLite ({SQLITE_DB_FILE}, WAL mode).")
+
+def close_storage() -> None:
+    """Closes the SQLite connection if one is open."""
+    global _sqlite_conn
+    if _sqlite_conn is not None:
+        _sqlite_conn.close()
+        _sqlite_conn = None
+
+# --- In-Memory State Store ---
+# Each data file under DATA_DIR is loaded from disk once and then served from
+# memory. Writes only mark a file dirty; the background flusher is the single
+# owner of persistence and coalesces all changes made within one
+# STATE_FLUSH_INTERVAL into one atomic write per file. Each dirty file maps to
+# the top-level keys (user ids) changed since the last flush, or None if the
+# whole file must be written.
+_state_cache: dict[str, dict | list | set] = {}
+_dirty_state_files: dict[str, set[str] | None] = {}
+
+def get_state(filepath: str, default_value=None) -> dict | list:
+    """Returns the in-memory copy of a state file, loading it from disk on first access."""
+    data = _state_cache.get(filepath)
+    if data is None:
+        table = _sqlite_table_for(filepath) if using_sqlite() else None
+        data = _sqlite_load_table(table) if table else load_json_data(filepath, default_value)
+        _state_cache[filepath] = data
+    return data
+
+def _mark_state_dirty(filepath: str, changed_keys) -> None:
+    if changed_keys is None or (filepath in _dirty_state_files and _dirty_state_files[filepath] is None):
+        _dirty_state_files[filepath] = None
+    else:
+        _dirty_state_files.setdefault(filepath, set()).update(str(key) for key in changed_keys)
+
+def set_state(filepath: str, data: dict | list | set, changed_keys=None) -> bool:
+    """
+    Replaces the in-memory copy of a state file and queues it for the next flush.
+    changed_keys names the top-level keys (user ids) that changed, so the SQLite backend
+    writes only their rows; without it the whole file is written.
+    """
+    _state_cache[filepath] = data
+    _mark_state_dirty(filepath, changed_keys)
+    return True
+
+def flush_state() -> bool:
+    """Writes every dirty state file to disk. Returns True if all writes succeeded."""
+    all_saved = flush_known_users_journal()
+    for filepath, changed_keys in list(_dirty_state_files.items()):
+        del _dirty_state_files[filepath]
+        data = _state_cache.get(filepath)
+        if data is None:
+            continue
+        table = _sqlite_table_for(filepath) if using_sqlite() else None
+        saved = _sqlite_sync_table(table, data, changed_keys) if table else save_json_data(filepath, data)
+        if not saved:
+            logger.error(f"State flush failed for {filepath}. Will retry on next flush.")
+            _mark_state_dirty(filepath, changed_keys)
+            all_saved = False
+    return all_saved
+
+async def run_state_flusher() -> None:
+    """Background task that persists dirty state files every STATE_FLUSH_INTERVAL seconds."""
+    logger.info(f"State flusher started. Flush interval: {STATE_FLUSH_INTERVAL}s")
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        if not _dirty_state_files and not _known_users_pending_records and not _known_users_needs_compaction:
+            continue
+        try:
+            flush_state()
+        except Exception as e:
+            logger.error(f"Unexpected error in state flusher: {e}", exc_info=True)
+
+def preload_state() -> None:
+    """Loads every state file into memory. Called once at startup."""
+    load_vip_data()
+    load_github_configs()
+    load_known_users()
+    load_scheduled_files()
+    load_rotation_files()
+    logger.info(f"State store loaded {len(_state_cache)} data file(s) into memory.")
+
 # --- VIP User Management ---
-def load_vip_data() -> dict:
-    """Loads VIP user data from the JSON file."""
-    return load_json_data(VIP_FILE, {})
+# VIP expiry dates are parsed once into an index of user_id -> expiry epoch,
+# rebuilt only when the VIP data is saved. A min-heap of expirations not yet
+# notified lets the expiry watcher sleep until the next VIP actually expires;
+# the watcher records each notification in the entry's 'expiry_notified'.
+_vip_expiry_index: dict[int, float] = {}
+_vip_expiry_heap: list[tuple[float, int]] = []
+_vip_index_built = False
+_vip_index_changed = asyncio.Event()
 
-def save_vip_data(data: dict) -> bool:
-    """Saves VIP user data to the JSON file."""
-    return save_json_data(VIP_FILE, data)
+def load_vip_data() -> dict:
+    """Returns the in-memory VIP user data."""
+    return get_state(VIP_FILE, {})
 
-def is_user_vip(user_id: int) -> bool:
-    """Checks if a user is currently a VIP by verifying their expiry date."""
-    vip_data = load_vip_data()
-    user_id_str = str(user_id)
-    if user_id_str in vip_data and isinstance(vip_data.get(user_id_str), dict):
+def save_vip_data(data: dict, changed_users=None) -> bool:
+    """
+    Saves VIP user data through the state store and rebuilds the expiry index.
+    changed_users lists the user ids whose entries changed (see set_state).
+    """
+    saved = set_state(VIP_FILE, data, changed_users)
+    _rebuild_vip_index(data)
+    invalidate_schedule_index()  # Schedules of users who are no longer VIP are dropped from the index
+    return saved
+
+def _rebuild_vip_index(vip_data: dict) -> None:
+    """Parses every VIP expiry into the epoch index and refills the heap of expiries still to notify."""
+    global _vip_expiry_index, _vip_expiry_heap, _vip_index_built
+    index = {}
+    notified = set()
+    for user_id_str, info in vip_data.items():
+        if not isinstance(info, dict):
+            continue
         try:
-            expiry_iso = vip_data[user_id_str].get('expiry')
-            if expiry_iso:
-                expiry_dt = datetime.fromisoformat(expiry_iso.replace('Z', '+00:00'))
-                return expiry_dt > datetime.now(timezone.utc)
-            else:
+            expiry_iso = info.get('expiry')
+            if not expiry_iso:
                 logger.debug(f"Missing or null 'expiry' for VIP user {user_id_str}. Assuming not VIP.")
-                return False
-        except (ValueError, KeyError, TypeError) as e:
+                continue
+            expiry_dt = datetime.fromisoformat(expiry_iso.replace('Z', '+00:00'))
+            if expiry_dt.tzinfo is None:
+                raise ValueError("expiry has no timezone")
+            index[int(user_id_str)] = expiry_dt.timestamp()
+            if info.get('expiry_notified') == expiry_iso:
+                notified.add(int(user_id_str))
+        except (ValueError, TypeError, AttributeError) as e:
             logger.warning(f"Invalid or missing VIP data format for user {user_id_str}: {e}. Assuming not VIP.")
-            return False
-    return False
+
+    # Expiries already past but not yet notified stay in the heap, so a rebuild right after
+    # someone's expiry (or a restart) doesn't skip their notification.
+    notify_after = time.time() - VIP_EXPIRY_NOTIFY_MAX_AGE
+    heap = [(expiry, user_id) for user_id, expiry in index.items() if expiry > notify_after and user_id not in notified]
+    heapq.heapify(heap)
+    _vip_expiry_index = index
+    _vip_expiry_heap = heap
+    _vip_index_built = True
+    _vip_index_changed.set()
+    logger.debug(f"Rebuilt VIP expiry index: {len(index)} entries, {len(heap)} expirations to notify.")
+
+def _ensure_vip_index() -> None:
+    """Builds the VIP expiry index on first use."""
+    if not _vip_index_built:
+        _rebuild_vip_index(load_vip_data())
+
+def is_user_vip(user_id: int) -> bool:
+    """Checks if a user is currently a VIP using the precomputed expiry index."""
+    _ensure_vip_index()
+    expiry = _vip_expiry_index.get(user_id)
+    return expiry is not None and expiry > time.time()
+
+def next_vip_expiry() -> float | None:
+    """Returns the epoch time of the next VIP expiration still to notify, if any (may be in the past)."""
+    _ensure_vip_index()
+    return _vip_expiry_heap[0][0] if _vip_expiry_heap else None
+
+def pop_expired_vips(now: float | None = None) -> list[int]:
+    """Pops and returns the users whose VIP expired at or before `now`."""
+    _ensure_vip_index()
+    now = time.time() if now is None else now
+    expired = []
+    while _vip_expiry_heap and _vip_expiry_heap[0][0] <= now:
+        expiry, user_id = heapq.heappop(_vip_expiry_heap)
+        if _vip_expiry_index.get(user_id) == expiry:
+            expired.append(user_id)
+    return expired
+
+def mark_vip_expiry_notified(user_ids: list[int]) -> None:
+    """Records in each user's VIP entry that the expiry it currently holds has been notified."""
+    vip_data = load_vip_data()
+    marked = False
+    for user_id in user_ids:
+        info = vip_data.get(str(user_id))
+        if isinstance(info, dict) and info.get('expiry'):
+            info['expiry_notified'] = info['expiry']
+            marked = True
+    if marked and not save_vip_data(vip_data, changed_users=user_ids):
+        logger.error(f"Failed to record VIP expiry notifications for users {user_ids}.")
 
 def get_vip_expiry(user_id: int) -> str | None:
     """Gets the VIP expiry date string if the user is currently VIP."""
@@ -222,17 +566,24 @@ def get_vip_expiry(user_id: int) -> str | None:
 
 # --- GitHub Config Management ---
 def load_github_configs() -> dict:
-    """Loads GitHub configuration data."""
-    return load_json_data(GITHUB_CONFIG_FILE, {})
+    """Returns the in-memory GitHub configuration data."""
+    return get_state(GITHUB_CONFIG_FILE, {})
 
-def save_github_configs(data: dict) -> bool:
-    """Saves GitHub configuration data."""
-    return save_json_data(GITHUB_CONFIG_FILE, data)
+def save_github_configs(data: dict, changed_users=None) -> bool:
+    """Saves GitHub configuration data through the state store; changed_users as for save_vip_data."""
+    return set_state(GITHUB_CONFIG_FILE, data, changed_users)
 
 # --- Known User Management (for Broadcast) ---
-def load_known_users() -> set:
-    """Loads known user IDs from the file into a set for efficient lookup."""
-    user_list = load_json_data(KNOWN_USERS_FILE, [])
+# Known users are stored as a JSON snapshot plus an append-only journal of
+# "+<id>" / "-<id>" records. Additions and removals only append to the journal;
+# once it grows past KNOWN_USERS_COMPACT_THRESHOLD records the current set is
+# written as a new snapshot and the journal is truncated.
+_known_users_pending_records: list[str] = []
+_known_users_journal_size = 0
+_known_users_needs_compaction = False
+
+def _parse_known_users(user_list) -> set:
+    """Converts the raw known users snapshot content into a set of valid integer IDs."""
     valid_users = set()
     if isinstance(user_list, list):
         for item in user_list:
@@ -242,36 +593,358 @@ def load_known_users() -> set:
                  valid_users.add(int(item))
     else:
         logger.error(f"Loaded known users data from {KNOWN_USERS_FILE} is not a list. Resetting to empty list.")
-        save_known_users(set())
-        return set()
+        save_json_data(KNOWN_USERS_FILE, [])
     return valid_users
 
+def _replay_known_users_journal(known_users: set) -> int:
+    """Applies the journal records on top of the snapshot set. Returns the number of records read."""
+    record_count = 0
+    try:
+        with open(KNOWN_USERS_JOURNAL, 'r', encoding='utf-8') as f:
+            for line in f:
+                op, uid_str = line[:1], line[1:].strip()
+                if not uid_str.isdigit():
+                    logger.warning(f"Skipping malformed known users journal record: {line.strip()[:30]}")
+                    continue
+                if op == '+':
+                    known_users.add(int(uid_str))
+                elif op == '-':
+                    known_users.discard(int(uid_str))
+                else:
+                    continue
+                record_count += 1
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Could not read known users journal {KNOWN_USERS_JOURNAL}: {e}")
+    return record_count
+
+def load_known_users() -> set:
+    """Returns the in-memory set of known user IDs, replaying snapshot and journal on first access."""
+    global _known_users_journal_size, _known_users_needs_compaction
+    known_users = _state_cache.get(KNOWN_USERS_FILE)
+    if known_users is None and using_sqlite():
+        known_users = {row[0] for row in _sqlite_conn.execute("SELECT user_id FROM known_users")}
+        _state_cache[KNOWN_USERS_FILE] = known_users
+        logger.info(f"Loaded {len(known_users)} known users from SQLite.")
+    elif known_users is None:
+        known_users = _parse_known_users(load_json_data(KNOWN_USERS_FILE, []))
+        _known_users_journal_size = _replay_known_users_journal(known_users)
+        if _known_users_journal_size >= KNOWN_USERS_COMPACT_THRESHOLD:
+            _known_users_needs_compaction = True
+        _state_cache[KNOWN_USERS_FILE] = known_users
+        logger.info(f"Loaded {len(known_users)} known users (replayed {_known_users_journal_size} journal records).")
+    return known_users
+
 def save_known_users(user_set: set) -> bool:
-    """Saves the set of user IDs back to the file as a sorted list of integers."""
-    int_user_list = sorted([int(uid) for uid in user_set if isinstance(uid, (int, str)) and str(uid).isdigit() and int(str(uid)) != 0])
-    return save_json_data(KNOWN_USERS_FILE, int_user_list)
+    """Replaces the whole known users set. It is written as a fresh snapshot on the next flush."""
+    global _known_users_needs_compaction
+    valid_set = {int(uid) for uid in user_set if isinstance(uid, (int, str)) and str(uid).isdigit() and int(str(uid)) != 0}
+    _state_cache[KNOWN_USERS_FILE] = valid_set
+    _known_users_pending_records.clear()
+    _known_users_needs_compaction = True
+    return True
 
 def add_known_user(user_id: int) -> None:
-    """Adds a user ID to the known users file if not already present."""
+    """Adds a user ID to the known users list if not already present."""
     if not isinstance(user_id, int) or user_id == 0:
         logger.debug(f"Attempted to add invalid user ID: {user_id}. Skipping.")
         return
     known_users = load_known_users()
     if user_id not in known_users:
         known_users.add(user_id)
-        if save_known_users(known_users):
-             logger.info(f"Added new user {user_id} to known users list ({len(known_users)} total).")
-        else:
-             logger.error(f"Failed attempt to save known users file after adding {user_id}.")
+        _known_users_pending_records.append(f"+{user_id}\n")
+        logger.info(f"Added new user {user_id} to known users list ({len(known_users)} total).")
+
+def remove_known_users(user_ids: set) -> int:
+    """Removes a batch of user IDs from the known users list. Returns the number actually removed."""
+    known_users = load_known_users()
+    removed = [uid for uid in user_ids if uid in known_users]
+    for uid in removed:
+        known_users.discard(uid)
+        _known_users_pending_records.append(f"-{uid}\n")
+    return len(removed)
+
+def _compact_known_users() -> bool:
+    """Writes the current known users set as a snapshot and truncates the journal."""
+    global _known_users_journal_size, _known_users_needs_compaction
+    if using_sqlite():
+        if not _sqlite_replace_known_users(load_known_users()):
+            return False
+        _known_users_needs_compaction = False
+        return True
+    if not save_json_data(KNOWN_USERS_FILE, sorted(load_known_users())):
+        return False
+    try:
+        with open(KNOWN_USERS_JOURNAL, 'w', encoding='utf-8'):
+            pass
+    except OSError as e:
+        # The snapshot already reflects every journal record, so replaying them again is harmless.
+        logger.error(f"Could not truncate known users journal after compaction: {e}")
+        return False
+    logger.info(f"Compacted known users journal ({_known_users_journal_size} records) into snapshot.")
+    _known_users_journal_size = 0
+    _known_users_needs_compaction = False
+    return True
+
+def flush_known_users_journal() -> bool:
+    """Appends pending known user records to the journal and compacts it when it grows too large."""
+    global _known_users_journal_size, _known_users_needs_compaction
+    if _known_users_pending_records and using_sqlite():
+        records = list(_known_users_pending_records)
+        _known_users_pending_records.clear()
+        if not _sqlite_apply_known_user_records(records):
+            _known_users_pending_records[:0] = records
+            return False
+    elif _known_users_pending_records:
+        records = list(_known_users_pending_records)
+        _known_users_pending_records.clear()
+        try:
+            with open(KNOWN_USERS_JOURNAL, 'a', encoding='utf-8') as f:
+                f.write("".join(records))
+            _known_users_journal_size += len(records)
+        except OSError as e:
+            logger.error(f"Could not append to known users journal: {e}. Will retry on next flush.")
+            _known_users_pending_records[:0] = records
+            return False
+    if _known_users_journal_size >= KNOWN_USERS_COMPACT_THRESHOLD:
+        _known_users_needs_compaction = True
+    if _known_users_needs_compaction:
+        return _compact_known_users()
+    return True
 
 # --- Scheduled File Management ---
 def load_scheduled_files() -> dict:
-    """Loads scheduled file configurations."""
-    return load_json_data(SCHEDULED_FILES_CONFIG, {})
+    """Returns the in-memory scheduled file configurations."""
+    return get_state(SCHEDULED_FILES_CONFIG, {})
+
+def save_scheduled_files(data: dict, reindex: bool = True, changed_users=None) -> bool:
+    """
+    Saves scheduled file configurations through the state store. By default the
+    next-run index is rebuilt; pass reindex=False after updating it with set_schedule_deadline.
+    changed_users lists the user ids whose schedules changed (see set_state).
+    """
+    saved = set_state(SCHEDULED_FILES_CONFIG, data, changed_users)
+    if reindex:
+        invalidate_schedule_index()
+    return saved
+
+# Rotation schedules (rotation_files.json) have a list of files and process one of them per
+# tick, advancing current_file_index, so a large account pool is spread over N intervals.
+# The latest tokens of each file are kept next to it (<stored file>.tokens.json) and the
+# tokens of all files in the rotation are merged into every upload.
+def load_rotation_files() -> dict:
+    """Returns the in-memory rotation schedules."""
+    return get_state(ROTATION_FILES_CONFIG, {})
+
+def save_rotation_files(data: dict, reindex: bool = True, changed_users=None) -> bool:
+    """Saves rotation schedules through the state store; see save_scheduled_files for reindex and changed_users."""
+    saved = set_state(ROTATION_FILES_CONFIG, data, changed_users)
+    if reindex:
+        invalidate_schedule_index()
+    return saved
+
+def resolve_stored_file_path(stored_file_path: str | None) -> str | None:
+    """
+    Returns a usable path for a stored schedule file. Paths written on another machine
+    (e.g. Windows paths in rotation_files.json) are looked up by file name in SCHEDULED_FILES_DATA_DIR.
+    """
+    if not stored_file_path or os.path.exists(stored_file_path):
+        return stored_file_path
+    local_path = os.path.join(SCHEDULED_FILES_DATA_DIR, ntpath.basename(stored_file_path))
+    return local_path if os.path.exists(local_path) else stored_file_path
 
-def save_scheduled_files(data: dict) -> bool:
-    """Saves scheduled file configurations."""
-    return save_json_data(SCHEDULED_FILES_CONFIG, data)
+def rotation_tokens_path(stored_file_path: str) -> str:
+    return stored_file_path + '.tokens.json'
+
+def rotation_tick_info(rotation_name: str, rotation: dict) -> dict | None:
+    """
+    Builds the schedule_info for a rotation's next tick: the file at current_file_index, where
+    to keep that file's tokens, and the token files of the whole rotation to merge for upload.
+    Returns None if the rotation has no files or an invalid entry.
+    """
+    files = rotation.get('files') if isinstance(rotation, dict) else None
+    if not files or not all(isinstance(entry, dict) and entry.get('stored_file_path') for entry in files):
+        return None
+    try:
+        file_index = int(rotation.get('current_file_index') or 0) % len(files)
+    except (ValueError, TypeError):
+        file_index = 0
+    stored_paths = [resolve_stored_file_path(entry['stored_file_path']) for entry in files]
+    return {
+        'interval_seconds': rotation.get('interval_seconds'),
+        'next_run_time_iso': rotation.get('next_run_time_iso'),
+        'stored_file_path': stored_paths[file_index],
+        'original_telegram_filename': files[file_index].get('original_telegram_filename'),
+        'account_count': files[file_index].get('account_count'),
+        'user_schedule_name': f"{rotation.get('rotation_name', rotation_name)} (file {file_index + 1}/{len(files)})",
+        'latest_tokens_path': rotation_tokens_path(stored_paths[file_index]),
+        'rotation_tokens_paths': [rotation_tokens_path(path) for path in stored_paths],
+    }
+
+def merge_rotation_tokens(token_paths: list[str]) -> list[str]:
+    """Unique, unexpired tokens from the given rotation token files, in file order."""
+    now = time.time()
+    merged = {}
+    for path in token_paths:
+        if not os.path.exists(path):
+            continue
+        tokens = load_json_data(path, [])
+        if not isinstance(tokens, list):
+            continue
+        for token in tokens:
+            if not isinstance(token, str):
+                continue
+            expiry = decode_jwt_expiry(token)
+            if expiry is None or expiry > now:
+                merged[token] = None
+    return list(merged)
+
+def delete_rotation_file_data(stored_file_paths: list[str]) -> int:
+    """Deletes rotation files, their token files and checkpoints. Returns how many stored files were deleted."""
+    deleted_count = 0
+    for stored_file_path in stored_file_paths:
+        schedule_checkpoint(stored_file_path).discard()
+        for path in (stored_file_path, rotation_tokens_path(stored_file_path)):
+            if path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                    deleted_count += path == stored_file_path
+                    logger.info(f"Deleted rotation file: {path}")
+                except OSError as e:
+                    logger.error(f"Error deleting rotation file {path}: {e}")
+    return deleted_count
+
+# Next-run times of all schedules are kept in a min-heap of (epoch, user_id_str, schedule_name),
+# so the scheduler sleeps until the earliest one instead of rescanning every schedule on a
+# timer. Rotations are indexed under ROTATION_KEY_PREFIX + rotation name. Deadlines include each schedule's fixed jitter (schedule_jitter), which is applied
+# in memory only; next_run_time_iso stays the nominal time. _schedule_deadlines holds the current deadline per schedule; heap entries that no
+# longer match it are stale and skipped. A schedule that is due is taken out of the index
+# until its run finishes and sets the next deadline.
+_schedule_deadlines: dict[tuple[str, str], float] = {}
+_schedule_heap: list[tuple[float, str, str]] = []
+_schedule_index_built = False
+_schedule_index_spread_overdue = True  # Only for the first build: schedules overdue at startup fire spread over their jitter
+_schedule_index_changed = asyncio.Event()
+
+def invalidate_schedule_index() -> None:
+    """Marks the next-run index for a rebuild and wakes the scheduler."""
+    global _schedule_index_built
+    _schedule_index_built = False
+    _schedule_index_changed.set()
+
+def schedule_jitter(user_id_str: str, schedule_name: str, interval_seconds: int) -> float:
+    """
+    Fixed offset in seconds for one schedule, derived from its key, so schedules set up at the
+    same moment (or all overdue after a restart) fire spread out instead of in the same second.
+    """
+    spread = min(SCHEDULE_JITTER_MAX, interval_seconds * SCHEDULE_JITTER_RATIO) if isinstance(interval_seconds, int) else 0
+    digest = hashlib.sha256(f"{user_id_str}\0{schedule_name}".encode('utf-8')).digest()
+    return spread * int.from_bytes(digest[:8], 'big') / 2**64
+
+def _rebuild_schedule_index(schedules: dict, rotations: dict) -> None:
+    """Parses every schedule's and rotation's next_run_time_iso into the deadline index and refills the heap."""
+    global _schedule_deadlines, _schedule_heap, _schedule_index_built, _schedule_index_spread_overdue
+    deadlines = {}
+    now = time.time()
+    for user_id_str, user_schedules, key_prefix in itertools.chain(
+        ((user_id_str, entries, '') for user_id_str, entries in schedules.items()),
+        ((user_id_str, entries, ROTATION_KEY_PREFIX) for user_id_str, entries in rotations.items()),
+    ):
+        if not isinstance(user_schedules, dict):
+            logger.warning(f"Scheduler: Invalid schedule data format for user {user_id_str}. Skipping.")
+            continue
+        for entry_name, schedule_info in user_schedules.items():
+            schedule_name = key_prefix + entry_name
+            next_run_iso = schedule_info.get('next_run_time_iso') if isinstance(schedule_info, dict) else None
+            try:
+                next_run_dt = datetime.fromisoformat(next_run_iso.replace('Z', '+00:00'))
+                if next_run_dt.tzinfo is None:
+                    raise ValueError("next run time has no timezone")
+                jitter = schedule_jitter(user_id_str, schedule_name, schedule_info.get('interval_seconds'))
+                due = next_run_dt.timestamp() + jitter
+                if _schedule_index_spread_overdue and due < now:
+                    # Overdue after downtime: all these deadlines are in the past, so offset them from now instead.
+                    due = now + jitter
+                deadlines[(user_id_str, schedule_name)] = due
+            except (ValueError, TypeError, AttributeError):
+                logger.warning(f"Scheduler: Skipping schedule '{schedule_name}' for user {user_id_str} due to invalid next_run_time_iso: {next_run_iso}")
+
+    heap = [(due, user_id_str, schedule_name) for (user_id_str, schedule_name), due in deadlines.items()]
+    heapq.heapify(heap)
+    _schedule_deadlines = deadlines
+    _schedule_heap = heap
+    _schedule_index_built = True
+    _schedule_index_spread_overdue = False
+    logger.debug(f"Rebuilt schedule index: {len(deadlines)} schedules.")
+
+def _ensure_schedule_index() -> None:
+    if not _schedule_index_built:
+        _rebuild_schedule_index(load_scheduled_files(), load_rotation_files())
+
+def set_schedule_deadline(user_id_str: str, schedule_name: str, due: float | None) -> None:
+    """Sets (or with due=None, removes) one schedule's next run in the index and wakes the scheduler."""
+    _ensure_schedule_index()
+    key = (user_id_str, schedule_name)
+    if due is None:
+        _schedule_deadlines.pop(key, None)
+    else:
+        _schedule_deadlines[key] = due
+        heapq.heappush(_schedule_heap, (due, user_id_str, schedule_name))
+    _schedule_index_changed.set()
+
+def next_schedule_deadline() -> float | None:
+    """Returns the epoch time of the earliest scheduled run, if any."""
+    _ensure_schedule_index()
+    while _schedule_heap:
+        due, user_id_str, schedule_name = _schedule_heap[0]
+        if _schedule_deadlines.get((user_id_str, schedule_name)) == due:
+            return due
+        heapq.heappop(_schedule_heap)
+    return None
+
+def pop_due_schedules(now: float | None = None) -> list[tuple[str, str]]:
+    """Pops and returns the (user_id_str, schedule_name) of schedules due at or before `now`."""
+    _ensure_schedule_index()
+    now = time.time() if now is None else now
+    due_schedules = []
+    while _schedule_heap and _schedule_heap[0][0] <= now:
+        due, user_id_str, schedule_name = heapq.heappop(_schedule_heap)
+        key = (user_id_str, schedule_name)
+        if _schedule_deadlines.get(key) == due:
+            del _schedule_deadlines[key]
+            due_schedules.append(key)
+    return due_schedules
+
+# --- Shared HTTP Sessions ---
+# One long-lived ClientSession per upstream host, so manual jobs, scheduled
+# runs and GitHub uploads reuse warm keep-alive connections instead of paying
+# a new TCP/TLS handshake for every batch.
+_http_sessions: dict[str, aiohttp.ClientSession] = {}
+
+def get_http_session(url: str) -> aiohttp.ClientSession:
+    """Returns the shared session for the URL's host, creating its connection pool on first use."""
+    host = urlsplit(url).netloc
+    session = _http_sessions.get(host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _http_sessions[host] = session
+        logger.info(f"Created shared HTTP connection pool for {host}.")
+    return session
+
+async def close_http_sessions() -> None:
+    """Closes every shared HTTP session. Called on shutdown."""
+    for host, session in list(_http_sessions.items()):
+        if not session.closed:
+            await session.close()
+        logger.info(f"Closed HTTP connection pool for {host}.")
+    _http_sessions.clear()
 
 # --- Command Buttons ---
 COMMAND_BUTTONS_LAYOUT = [
@@ -283,12 +956,42 @@ COMMAND_BUTTONS_LAYOUT = [
 main_reply_markup = ReplyKeyboardMarkup(COMMAND_BUTTONS_LAYOUT, resize_keyboard=True, one_time_keyboard=False)
 
 # --- Channel Membership Check ---
-async def is_user_joined_channel(bot, user_id: int) -> bool:
+# Results of get_chat_member are cached per user as (is_member, expires_at, updated_at).
+# Concurrent checks for the same user share one in-flight API call.
+_membership_cache: dict[int, tuple[bool, float, float]] = {}
+_membership_inflight: dict[int, asyncio.Task] = {}
+
+def set_channel_membership(user_id: int, is_member: bool) -> None:
+    """Caches a known membership status, e.g. from a chat member update."""
+    now = time.monotonic()
+    ttl = CHANNEL_MEMBER_CACHE_TTL if is_member else CHANNEL_NON_MEMBER_CACHE_TTL
+    _membership_cache[user_id] = (is_member, now + ttl, now)
+
+async def _fetch_channel_membership(bot, user_id: int) -> bool:
+    """Asks Telegram for the user's channel status and caches the result."""
+    started = time.monotonic()
     try:
         member = await bot.get_chat_member(f"@{CHANNEL_USERNAME}", user_id)
-        return member.status in ['member', 'administrator', 'creator']
-    except TelegramError:
+    except TelegramError as e:
+        logger.debug(f"Channel membership check failed for user {user_id}: {e}")
         return False
+    is_member = member.status in ['member', 'administrator', 'creator']
+    existing = _membership_cache.get(user_id)
+    if not existing or existing[2] <= started:
+        set_channel_membership(user_id, is_member)
+    return is_member
+
+async def is_user_joined_channel(bot, user_id: int) -> bool:
+    cached = _membership_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    task = _membership_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_channel_membership(bot, user_id))
+        _membership_inflight[user_id] = task
+        task.add_done_callback(lambda _: _membership_inflight.pop(user_id, None))
+    return await asyncio.shield(task)
 
 async def check_channel_membership(update: Update, context: CallbackContext) -> bool:
     user_id = update.effective_user.id
@@ -363,12 +1066,15 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "  `/setfile <Interval> <ScheduleName.json>` - Start scheduling a file for auto-processing (e.g., `/setfile 12h my_accounts.json`). Bot will ask for the file.\n"
         "     *Interval format:* `Xm` (minutes), `Xh` (hours), `Xd` (days). Min interval: 5m.\n"
         "  `/removefile <ScheduleName.json>` - Stop auto-processing for a scheduled file.\n"
-        "  `/scheduledfiles` - List your currently scheduled files.\n\n"
+        "  `/addrotationfile <Interval> <RotationName>` - Add a file to a rotation; each run processes the next file. Bot will ask for the file.\n"
+        "  `/removerotationfile <RotationName> [FileNumber]` - Remove one file from a rotation, or the whole rotation.\n"
+        "  `/scheduledfiles` - List your currently scheduled files and rotations.\n\n"
         "👑 *Admin Commands (Bot Admin only - requires ADMIN_ID to be set):*\n"
         "  `/vip add <user_id> <days>` - Add/extend VIP\n"
         "  `/vip remove <user_id>` - Remove VIP, GitHub config & ALL user's scheduled files\n"
         "  `/vip list` - Show active VIP users\n"
-        "  `/broadcast <message>` - Send a message to all known users\n\n"
+        "  `/broadcast <message>` - Send a message to all known users\n"
+        "  `/apistatus` - Show token API concurrency, latency and error rate\n\n"
         "📤 *Manual Processing:*\n"
         "  1. Send a JSON file formatted with UID-password pairs.\n"
         "  2. The bot processes it and returns result files.\n"
@@ -474,92 +1180,1089 @@ async def cancel(update: Update, context: CallbackContext) -> None:
             reply_markup=main_reply_markup
         )
 
+# --- Upstream Concurrency Control ---
+
+class FairConcurrencyLimiter:
+    """
+    Caps the number of concurrent upstream calls across the whole process.
+    When all slots are busy, freed slots are handed out round-robin between owners
+    (users) that have requests waiting, so a huge job can't starve a small one.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.active_by_owner: dict[object, int] = defaultdict(int)
+        self._waiters: dict[object, deque[asyncio.Future]] = {}
+        self._turn_order: deque = deque()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._waiters.values())
+
+    def _grant(self, owner) -> None:
+        self.active += 1
+        self.active_by_owner[owner] += 1
+
+    def _wake_next(self) -> None:
+        while self.active < self.limit and self._turn_order:
+            owner = self._turn_order.popleft()
+            queue = self._waiters[owner]
+            future = queue.popleft()
+            if queue:
+                self._turn_order.append(owner)
+            else:
+                del self._waiters[owner]
+            if future.done():
+                continue
+            self._grant(owner)
+            future.set_result(None)
+
+    async def acquire(self, owner) -> None:
+        if self.active < self.limit and not self._waiters:
+            self._grant(owner)
+            return
+        future = asyncio.get_running_loop().create_future()
+        queue = self._waiters.get(owner)
+        if queue is None:
+            queue = self._waiters[owner] = deque()
+            self._turn_order.append(owner)
+        queue.append(future)
+        self._wake_next()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(owner)
+            raise
+
+    def set_limit(self, limit: int) -> None:
+        self.limit = limit
+        self._wake_next()
+
+    def release(self, owner) -> None:
+        self.active -= 1
+        self.active_by_owner[owner] -= 1
+        if self.active_by_owner[owner] <= 0:
+            del self.active_by_owner[owner]
+        self._wake_next()
+
+    @asynccontextmanager
+    async def slot(self, owner):
+        await self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release(owner)
+
+class AdaptiveConcurrencyController:
+    """
+    AIMD controller for the limiter's size. After each full round of calls it
+    adds one slot if p95 latency and the error rate are low and the limit is
+    actually in use; any timeout, connection failure, 429 or 5xx cuts the limit
+    by 30% (at most once per cooldown).
+    """
+
+    def __init__(self, limiter: FairConcurrencyLimiter, min_limit: int, max_limit: int, latency_target: float,
+                 window: int = 100, decrease_cooldown: float = 5.0):
+        self.limiter = limiter
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_cooldown = decrease_cooldown
+        self.samples: deque[tuple[float, bool]] = deque(maxlen=window)
+        self._calls_since_adjust = 0
+        self._last_decrease = 0.0
+
+    def p95_latency(self) -> float | None:
+        if not self.samples:
+            return None
+        latencies = sorted(latency for latency, _ in self.samples)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, overloaded in self.samples if overloaded) / len(self.samples)
+
+    def record(self, latency: float, overloaded: bool) -> None:
+        """Records one upstream call and adjusts the limit."""
+        self.samples.append((latency, overloaded))
+        now = time.monotonic()
+        current = self.limiter.limit
+
+        if overloaded:
+            if now - self._last_decrease >= self.decrease_cooldown:
+                new_limit = max(self.min_limit, int(current * 0.7))
+                if new_limit != current:
+                    logger.warning(f"Upstream overloaded (timeout/429/5xx). Reducing API concurrency {current} -> {new_limit}.")
+                    self.limiter.set_limit(new_limit)
+                self._last_decrease = now
+            self._calls_since_adjust = 0
+            return
+
+        self._calls_since_adjust += 1
+        if self._calls_since_adjust < current or len(self.samples) < 20:
+            return
+        self._calls_since_adjust = 0
+
+        p95 = self.p95_latency()
+        saturated = self.limiter.active + self.limiter.waiting >= current
+        if p95 <= self.latency_target and self.error_rate() <= 0.02 and saturated and current < self.max_limit:
+            self.limiter.set_limit(current + 1)
+            logger.debug(f"Upstream healthy (p95 {p95:.2f}s). Increasing API concurrency to {current + 1}.")
+        elif p95 > self.latency_target and current > self.min_limit:
+            self.limiter.set_limit(current - 1)
+            logger.info(f"Upstream latency high (p95 {p95:.2f}s). Reducing API concurrency to {current - 1}.")
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open breaker for the token API. After failure_threshold
+    consecutive transient failures it opens and calls fail immediately; once
+    recovery_timeout has passed one probe call is let through (half-open) and
+    its outcome either closes the breaker again or re-opens it. Other calls
+    wait for that outcome (wait_for_probe) rather than failing.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+        self._probe_done = asyncio.Event()
+        self._probe_done.set()
+
+    def seconds_until_probe(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def rejecting(self) -> bool:
+        """True while calls should fail fast without waiting for a limiter slot."""
+        return self.state == self.OPEN and self.seconds_until_probe() > 0
+
+    async def wait_for_probe(self) -> None:
+        """Parks the caller while the half-open probe is in flight, until it closes or re-opens the breaker."""
+        while self.state == self.HALF_OPEN and self._probe_in_flight:
+            await self._probe_done.wait()
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if self.seconds_until_probe() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            logger.info("Token API circuit half-open: sending a probe request.")
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        self._probe_done.clear()
+        return True
+
+    def release_probe(self) -> None:
+        """Frees the half-open probe slot when a call is abandoned without an outcome."""
+        self._probe_in_flight = False
+        self._probe_done.set()
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info("Token API circuit closed: upstream is responding again.")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        self._probe_done.set()
+
+    def record_failure(self) -> None:
+        self._probe_in_flight = False
+        self._probe_done.set()
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            logger.warning(f"Token API circuit OPEN after {self.consecutive_failures} consecutive failures. Failing fast for {self.recovery_timeout}s.")
+
+api_limiter = FairConcurrencyLimiter(MAX_CONCURRENT_REQUESTS)
+api_concurrency = AdaptiveConcurrencyController(api_limiter, MIN_GLOBAL_CONCURRENT_REQUESTS, MAX_GLOBAL_CONCURRENT_REQUESTS, API_LATENCY_TARGET_P95)
+api_breaker = CircuitBreaker(API_BREAKER_FAILURE_THRESHOLD, API_BREAKER_RECOVERY_TIMEOUT)
+UPSTREAM_UNAVAILABLE_REASON = "Upstream Unavailable (circuit open)"
+
+# --- Token Cache ---
+
+def decode_jwt_expiry(token: str) -> int | None:
+    """Reads the `exp` claim (epoch seconds) from a JWT's payload without verifying it."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return int(exp) if isinstance(exp, (int, float)) else None
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+class TokenCache:
+    """
+    In-memory cache of issued tokens keyed by a hash of uid and password, so
+    credentials are never kept as keys. Entries are reused only while the
+    token has at least min_remaining seconds left, and are evicted on expiry
+    or, beyond max_entries, least recently used first.
+    """
+
+    def __init__(self, max_entries: int, min_remaining: float):
+        self.max_entries = max_entries
+        self.min_remaining = min_remaining
+        self._entries: OrderedDict[str, tuple[str, str | None, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key_for(uid: str, password: str) -> str:
+        return hashlib.sha256(f"{uid}\0{password}".encode('utf-8')).hexdigest()
+
+    def get(self, uid: str, password: str) -> tuple[str, str | None] | None:
+        key = self.key_for(uid, password)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        token, region, expires_at = entry
+        if expires_at - time.time() < self.min_remaining:
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return token, region
+
+    def put(self, uid: str, password: str, token: str, region: str | None) -> None:
+        expires_at = decode_jwt_expiry(token)
+        if expires_at is None or expires_at - time.time() < self.min_remaining:
+            return
+        key = self.key_for(uid, password)
+        self._entries[key] = (token, region, expires_at)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self.purge_expired()
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def purge_expired(self) -> int:
+        cutoff = time.time() + self.min_remaining
+        expired = [key for key, (_, _, expires_at) in self._entries.items() if expires_at < cutoff]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+token_cache = TokenCache(TOKEN_CACHE_MAX_ENTRIES, TOKEN_CACHE_MIN_REMAINING)
+
 # --- File Processing Logic ---
 
-async def process_account(session: aiohttp.ClientSession, account: dict, semaphore: asyncio.Semaphore) -> tuple[str | None, str | None, dict | None, dict | None, str | None]:
+class AccountResult:
+    """
+    Outcome of processing one account. The account dict is referenced, not copied; for
+    lost accounts it also carries error_reason so it can be written to lost_account.json as is.
+    index is the item's position in the input file, set by AccountWorkerPool for checkpointing.
+    """
+
+    __slots__ = ('token', 'region', 'account', 'error_reason', 'index')
+
+    def __init__(self, account: dict, token: str | None = None, region: str | None = None, error_reason: str | None = None):
+        self.account = account
+        self.token = token
+        self.region = region
+        self.error_reason = error_reason
+        self.index = None
+
+    @classmethod
+    def lost(cls, account: dict, error_reason: str) -> "AccountResult":
+        account["error_reason"] = error_reason
+        return cls(account, error_reason=error_reason)
+
+class RetryBudget:
+    """
+    Batch-wide allowance of retries. Once it is spent, transient failures are
+    recorded as lost straight away, so an upstream outage isn't multiplied by
+    every account in the file retrying on its own. The allowance grows with
+    total_accounts, which streaming callers raise as accounts are parsed.
+    """
+
+    def __init__(self, total_accounts: int = 0):
+        self.total_accounts = total_accounts
+        self.retries_used = 0
+        self.retried_successes = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(API_RETRY_BUDGET_MIN, int(self.total_accounts * API_RETRY_BUDGET_RATIO)) - self.retries_used
+
+    @property
+    def exhausted(self) -> bool:
+        return self.remaining <= 0
+
+    def try_spend(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        self.retries_used += 1
+        return True
+
+def retry_backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff: uniform(0, min(cap, base * 2^attempt))."""
+    return random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * (2 ** attempt)))
+
+async def request_token(session: aiohttp.ClientSession, uid_str: str, password: str) -> tuple[str | None, str | None, str | None, bool]:
+    """
+    Makes a single token API call for one account.
+    Reports its latency and outcome to api_concurrency and api_breaker; the caller must hold an
+    api_limiter slot and have been let through by api_breaker.allow_request(). 429 and 5xx
+    responses, timeouts and connection or client errors count as the upstream being overloaded
+    or unreachable, any other response as healthy; a call that ends without either (cancelled,
+    or an unexpected error in the bot) only frees the breaker's probe slot.
+    Returns: tuple(token | None, region | None, error_reason | None, retryable)
+    """
+    params = {'uid': uid_str, 'password': password, 'key': API_KEY}
+    request_started = time.monotonic()
+    upstream_overloaded = False
+    upstream_responded = False
+    try:
+        async with session.get(API_BASE_URL, params=params, timeout=aiohttp.ClientTimeout(total=60)) as response:
+            response_text = await response.text()
+            upstream_overloaded = response.status == 429 or response.status >= 500
+            upstream_responded = True
+
+            if 200 <= response.status < 300:
+                try:
+                    result = json.loads(response_text)
+                    if isinstance(result, dict) and result.get('token'):
+                        token = result['token']
+                        region = result.get('region')
+                        logger.info(f"Success: Token received for UID: {uid_str} (Region: {region})")
+                        return token, region, None, False
+                    else:
+                        err_msg = "API OK but invalid response format or empty token"
+                        logger.warning(f"{err_msg} for UID: {uid_str}. Response: {response_text[:200]}")
+                        return None, None, err_msg, False
+                except json.JSONDecodeError:
+                    err_msg = f"API OK ({response.status}) but Non-JSON response"
+                    logger.error(f"{err_msg} for UID: {uid_str}. Response: {response_text[:200]}")
+                    return None, None, err_msg, False
+                except Exception as e:
+                     err_msg = f"API OK ({response.status}) but response parsing error: {e}"
+                     logger.error(f"{err_msg} for UID: {uid_str}", exc_info=True)
+                     return None, None, err_msg, False
+
+            else:
+                error_detail = f"API Error ({response.status})"
+                try:
+                    error_json = json.loads(response_text)
+                    if isinstance(error_json, dict):
+                        msg = error_json.get('message') or error_json.get('error') or error_json.get('detail')
+                        if msg and isinstance(msg, str):
+                            error_detail += f": {msg[:100]}"
+                except (json.JSONDecodeError, TypeError): pass
+
+                logger.warning(f"API Error for UID: {uid_str}. Status: {response.status}. Detail: {error_detail}. Raw Response: {response_text[:200]}")
+                return None, None, error_detail, response.status in RETRYABLE_API_STATUSES
+
+    except asyncio.TimeoutError:
+         upstream_overloaded = True
+         logger.warning(f"Timeout processing API request for UID: {uid_str}")
+         return None, None, "Request Timeout", True
+    except aiohttp.ClientConnectorError as e:
+         upstream_overloaded = True
+         logger.error(f"Network Connection Error processing UID {uid_str}: {e}")
+         return None, None, f"Network Error: {e}", True
+    except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError) as e:
+         upstream_overloaded = True
+         logger.warning(f"Connection dropped processing UID {uid_str}: {e}")
+         return None, None, f"Connection Error: {e}", True
+    except aiohttp.ClientError as e:
+         upstream_overloaded = True
+         logger.error(f"AIOHTTP Client Error processing UID {uid_str}: {e}")
+         return None, None, f"HTTP Client Error: {e}", False
+    except Exception as e:
+         logger.error(f"Unexpected error processing UID {uid_str}: {e}", exc_info=True)
+         return None, None, f"Unexpected Processing Error: {e}", False
+    finally:
+        api_concurrency.record(time.monotonic() - request_started, upstream_overloaded)
+        if upstream_overloaded:
+            api_breaker.record_failure()
+        elif upstream_responded:
+            api_breaker.record_success()
+        else:
+            api_breaker.release_probe()
+
+async def process_account(session: aiohttp.ClientSession, account: dict, owner_id: int,
+                          retry_budget: RetryBudget | None = None) -> AccountResult:
     """
     Processes a single account via the API to get a JWT token and potentially region.
-    Returns: tuple(token | None, region | None, working_account | None, lost_account | None, error_reason | None)
+    Each attempt holds a fair share of the global api_limiter; transient failures (timeouts, dropped
+    connections, 429, 502/503/504) are retried with jittered backoff while retry_budget allows,
+    and the slot is given back while waiting. While api_breaker is open the account fails fast
+    with UPSTREAM_UNAVAILABLE_REASON instead of waiting out the request timeout; while its
+    half-open probe is in flight the account waits for the probe's outcome.
+    Tokens still valid in token_cache are returned without calling the API at all.
+    Returns: AccountResult with either token/region set or error_reason set.
     """
     uid = account.get("uid")
     password = account.get("password")
     error_reason = None
-    original_account_info = account.copy()
 
     if not uid: error_reason = "Missing 'uid'"
     elif not password: error_reason = "Missing 'password'"
 
     if error_reason:
         logger.debug(f"Skipping account due to validation error: {error_reason} - Account: {account}")
-        lost_info = {**original_account_info, "error_reason": error_reason}
-        return None, None, None, lost_info, error_reason
+        return AccountResult.lost(account, error_reason)
 
     uid_str = str(uid)
+    cached = token_cache.get(uid_str, str(password))
+    if cached:
+        logger.debug(f"Cache hit: Reusing token for UID: {uid_str}")
+        return AccountResult(account, token=cached[0], region=cached[1])
+
+    attempt = 0
+
+    while True:
+        await api_breaker.wait_for_probe()
+        if api_breaker.rejecting():
+            token, region, error_reason, retryable = None, None, UPSTREAM_UNAVAILABLE_REASON, False
+        else:
+            async with api_limiter.slot(owner_id):
+                if api_breaker.allow_request():
+                    token, region, error_reason, retryable = await request_token(session, uid_str, password)
+                elif api_breaker.state == CircuitBreaker.HALF_OPEN:
+                    # Another call became the probe while this one waited for a slot.
+                    continue
+                else:
+                    token, region, error_reason, retryable = None, None, UPSTREAM_UNAVAILABLE_REASON, False
+
+        if token:
+            token_cache.put(uid_str, str(password), token, region)
+            if attempt > 0 and retry_budget:
+                retry_budget.retried_successes += 1
+            return AccountResult(account, token=token, region=region)
 
-    async with semaphore:
-        params = {'uid': uid_str, 'password': password, 'key': API_KEY}
+        if not retryable or attempt >= API_MAX_RETRIES or retry_budget is None or not retry_budget.try_spend():
+            return AccountResult.lost(account, error_reason)
+
+        delay = retry_backoff_delay(attempt)  # The first retry draws from the base delay
+        attempt += 1
+        logger.info(f"Retrying UID {uid_str} in {delay:.1f}s (retry {attempt}/{API_MAX_RETRIES}) after: {error_reason}")
+        await asyncio.sleep(delay)
+
+def iter_json_array(file_obj, chunk_size: int = JSON_STREAM_CHUNK_SIZE):
+    """
+    Yields the items of a top-level JSON array from a text file one at a time, holding only the
+    unparsed remainder of the current chunk in memory.
+    Raises ValueError if the document is not an array, and json.JSONDecodeError (with line and
+    column relative to the whole file) on malformed JSON.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    lines_dropped = 0  # Newlines in text already discarded from buf
+    column_offset = 0  # Length of the partial line discarded from buf
+
+    def read_more() -> bool:
+        nonlocal buf, pos, eof, lines_dropped, column_offset
+        if eof:
+            return False
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        dropped = buf[:pos]
+        last_newline = dropped.rfind('\n')
+        if last_newline == -1:
+            column_offset += len(dropped)
+        else:
+            lines_dropped += dropped.count('\n')
+            column_offset = len(dropped) - last_newline - 1
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def located(err: json.JSONDecodeError) -> json.JSONDecodeError:
+        if err.lineno == 1:
+            err.colno += column_offset
+        err.lineno += lines_dropped
+        return err
+
+    def next_char() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not read_more():
+                return ''
+
+    first = next_char()
+    if first == '\ufeff':
+        pos += 1
+        first = next_char()
+    if first != '[':
+        if first and first in '{"-0123456789tfn':
+            raise ValueError("Input JSON structure is invalid. It must be an array (a list `[...]`) of objects.")
+        raise located(json.JSONDecodeError("Expecting value", buf, pos))
+    pos += 1
+
+    if next_char() == ']':
+        pos += 1
+    else:
+        while True:
+            next_char()
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError as e:
+                    if len(buf) - pos < JSON_STREAM_MAX_ITEM_SIZE and read_more():
+                        continue
+                    raise located(e)
+                if (not isinstance(item, (dict, list, str)) and (end == len(buf) or buf[end] not in ' \t\r\n,]')
+                        and len(buf) - pos < JSON_STREAM_MAX_ITEM_SIZE and read_more()):
+                    continue  # A number or literal may continue in the next chunk
+                break
+            pos = end
+            yield item
+
+            separator = next_char()
+            if separator == ',':
+                pos += 1
+            elif separator == ']':
+                pos += 1
+                break
+            else:
+                raise located(json.JSONDecodeError("Expecting ',' delimiter", buf, pos))
+
+    if next_char():
+        raise located(json.JSONDecodeError("Extra data", buf, pos))
+
+class AccountDeduplicator:
+    """
+    Filters accounts with the same uid and password (compared as trimmed strings) so each account
+    is sent to the API once. Entries reusing a uid with a different password are all admitted and
+    their uids recorded as conflicts. Entries missing a uid or password are passed through for validation.
+    """
+
+    def __init__(self):
+        self.duplicates_removed = 0
+        # 16-byte digests rather than the strings themselves, to keep per-account memory small on large files.
+        self._seen_pairs: set[bytes] = set()
+        self._password_by_uid: dict[str, bytes] = {}
+        self._conflicting_uids: dict[str, None] = {}
+
+    @property
+    def conflicting_uids(self) -> list[str]:
+        return list(self._conflicting_uids)
+
+    def admit(self, account: dict) -> bool:
+        uid = account.get("uid")
+        password = account.get("password")
+        if not uid or not password:
+            return True
+
+        uid_key = str(uid).strip()
+        password_hash = hashlib.blake2b(str(password).strip().encode('utf-8'), digest_size=16).digest()
+        # The password digest has a fixed length, so uid + digest identifies the pair unambiguously.
+        pair_hash = hashlib.blake2b(uid_key.encode('utf-8') + password_hash, digest_size=16).digest()
+        if pair_hash in self._seen_pairs:
+            self.duplicates_removed += 1
+            return False
+        self._seen_pairs.add(pair_hash)
+        if self._password_by_uid.setdefault(uid_key, password_hash) != password_hash:
+            self._conflicting_uids[uid_key] = None
+        return True
+
+class JsonArrayFileWriter:
+    """Writes a JSON array to disk one item at a time, formatted the same way as save_json_data."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def append(self, item) -> None:
+        prefix = "[\n    " if self.count == 0 else ",\n    "
+        self._file.write(prefix + json.dumps(item, indent=4, ensure_ascii=False).replace("\n", "\n    "))
+        self.count += 1
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.write("\n]" if self.count else "[]")
+            self._file.close()
+
+class JobResults:
+    """
+    Single store for the outcome of one processing job, producing its output files
+    (all_server_token.json, token_<region>.json, account_<region>.json and
+    lost_account.json) in output_dir. Each token and account is held once, in its
+    AccountResult, and region names are interned so results share one string per region.
+    With stream_to_disk results are appended to their files as they arrive instead,
+    so memory use doesn't grow with the input.
+    """
+
+    TOKEN_FILE_NAME = 'all_server_token.json'
+    LOST_FILE_NAME = 'lost_account.json'
+
+    def __init__(self, output_dir: str, stream_to_disk: bool = False):
+        self.output_dir = output_dir
+        self.stream_to_disk = stream_to_disk
+        self.success_count = 0
+        self.lost_count = 0
+        self.region_counts: dict[str, int] = defaultdict(int)
+        self._region_names: dict[str, str] = {}  # Interning table: one shared string per region
+        self._region_file_bases: dict[str, str] = {}
+        self._successes: list[AccountResult] = []
+        self._lost: list[AccountResult] = []
+        self._writers: dict[str, JsonArrayFileWriter] = {}
+        self._failed_files: set[str] = set()
+        if stream_to_disk:
+            os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def token_file_path(self) -> str | None:
+        return os.path.join(self.output_dir, self.TOKEN_FILE_NAME) if self.success_count else None
+
+    def add(self, result: AccountResult) -> None:
+        if result.token:
+            region = self._region_names.setdefault(result.region or "Unknown", result.region or "Unknown")
+            if region not in self._region_file_bases:
+                self._region_file_bases[region] = os.path.splitext(sanitize_filename(region))[0]
+            result.region = region
+            self.success_count += 1
+            self.region_counts[result.region] += 1
+            if self.stream_to_disk:
+                self._write_success(result)
+            else:
+                self._successes.append(result)
+        else:
+            self.lost_count += 1
+            if self.stream_to_disk:
+                self._write(self.LOST_FILE_NAME, result.account)
+            else:
+                self._lost.append(result)
+
+    def _write(self, file_name: str, item) -> None:
+        if file_name in self._failed_files:
+            return
         try:
-            async with session.get(API_BASE_URL, params=params, timeout=aiohttp.ClientTimeout(total=60)) as response:
-                response_text = await response.text()
+            writer = self._writers.get(file_name)
+            if writer is None:
+                writer = self._writers[file_name] = JsonArrayFileWriter(os.path.join(self.output_dir, file_name))
+            writer.append(item)
+        except OSError as e:
+            logger.error(f"Could not write result file {file_name} in {self.output_dir}: {e}")
+            self._failed_files.add(file_name)
+
+    def _write_success(self, result: AccountResult) -> None:
+        base = self._region_file_bases[result.region]
+        token_item = {"token": result.token}
+        self._write(self.TOKEN_FILE_NAME, token_item)
+        self._write(f'token_{base}.json', token_item)
+        self._write(f'account_{base}.json', result.account)
+
+    def write_files(self) -> tuple[list[tuple[str, str]], list[str]]:
+        """
+        Finishes every output file.
+        Returns: tuple(sorted list of (path, file_name) written, list of file_names that failed)
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        for result in self._successes:
+            self._write_success(result)
+        for result in self._lost:
+            self._write(self.LOST_FILE_NAME, result.account)
+        self._successes.clear()
+        self._lost.clear()
+
+        written = []
+        for file_name, writer in self._writers.items():
+            if file_name in self._failed_files:
+                continue
+            try:
+                writer.close()
+            except OSError as e:
+                logger.error(f"Could not finish result file {writer.path}: {e}")
+                self._failed_files.add(file_name)
+                continue
+            written.append((writer.path, file_name))
+        return sorted(written, key=lambda entry: entry[1]), sorted(self._failed_files)
+
+    def close(self) -> None:
+        """Closes any open result files without writing the rest (used when a job is abandoned)."""
+        for writer in self._writers.values():
+            try:
+                writer.close()
+            except OSError:
+                pass
 
-                if 200 <= response.status < 300:
+class AccountWorkerPool:
+    """
+    Runs process_account over a stream of accounts with a fixed number of workers pulling
+    from a bounded queue, so memory and event-loop overhead scale with the worker count
+    rather than the number of accounts. Accounts are read from the iterable only as workers
+    free up, which lets callers feed it straight from a streaming parser. The iterable yields
+    (index, item) pairs; an item that is already an AccountResult (restored from a
+    checkpoint) is passed through without calling the API.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, owner_id: int, retry_budget: RetryBudget,
+                 workers: int = ACCOUNT_WORKERS_PER_JOB):
+        self.session = session
+        self.owner_id = owner_id
+        self.retry_budget = retry_budget
+        self.workers = workers
+        self.submitted = 0
+        self.input_done = False
+        self.input_error: Exception | None = None
+
+    async def results(self, accounts):
+        """
+        Async generator yielding one AccountResult per item of accounts, in completion order,
+        with result.index set to the item's index. Items that aren't JSON objects yield a lost
+        result. A ValueError or OSError raised by the iterable (e.g. malformed JSON further into
+        a file) stops reading and is kept in input_error; accounts already submitted still finish.
+        """
+        account_queue = asyncio.Queue(maxsize=self.workers * 2)
+        result_queue = asyncio.Queue(maxsize=self.workers * 2)
+
+        async def feed_accounts():
+            cancelled = False
+            try:
+                for index, item in accounts:
+                    self.submitted += 1
+                    if isinstance(item, AccountResult):
+                        item.index = index
+                        await result_queue.put(item)
+                        continue
+                    self.retry_budget.total_accounts += 1
+                    if isinstance(item, dict):
+                        await account_queue.put((index, item))
+                    else:
+                        result = AccountResult.lost({"account_info": item}, "Item is not a JSON object")
+                        result.index = index
+                        await result_queue.put(result)
+                    if self.submitted % 500 == 0:
+                        await asyncio.sleep(0)
+            except (ValueError, OSError) as e:
+                logger.warning(f"Stopped reading accounts for user {self.owner_id} after {self.submitted} items: {e}")
+                self.input_error = e
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                self.input_done = True
+                if not cancelled:
+                    for _ in range(self.workers):
+                        await account_queue.put(None)
+
+        async def work_accounts():
+            cancelled = False
+            try:
+                while (queued := await account_queue.get()) is not None:
+                    index, account = queued
                     try:
-                        result = json.loads(response_text)
-                        if isinstance(result, dict) and result.get('token'):
-                            token = result['token']
-                            region = result.get('region')
-                            logger.info(f"Success: Token received for UID: {uid_str} (Region: {region})")
-                            return token, region, original_account_info, None, None
-                        else:
-                            err_msg = "API OK but invalid response format or empty token"
-                            logger.warning(f"{err_msg} for UID: {uid_str}. Response: {response_text[:200]}")
-                            lost_info = {**original_account_info, "error_reason": err_msg}
-                            return None, None, None, lost_info, err_msg
-                    except json.JSONDecodeError:
-                        err_msg = f"API OK ({response.status}) but Non-JSON response"
-                        logger.error(f"{err_msg} for UID: {uid_str}. Response: {response_text[:200]}")
-                        lost_info = {**original_account_info, "error_reason": err_msg}
-                        return None, None, None, lost_info, err_msg
-                    except Exception as e:
-                         err_msg = f"API OK ({response.status}) but response parsing error: {e}"
-                         logger.error(f"{err_msg} for UID: {uid_str}", exc_info=True)
-                         lost_info = {**original_account_info, "error_reason": err_msg}
-                         return None, None, None, lost_info, err_msg
+                        result = await process_account(self.session, account, self.owner_id, self.retry_budget)
+                    except Exception as task_err:
+                        logger.error(f"Error retrieving result from processing task: {task_err}", exc_info=True)
+                        result = AccountResult.lost({"account_info": "unknown"}, f"Internal task error: {task_err}")
+                    result.index = index
+                    await result_queue.put(result)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                # Even a worker that died must hand in its sentinel, or the consumer waits forever.
+                # Cancelled workers are being torn down with the pool, which no longer reads the queue.
+                if not cancelled:
+                    await result_queue.put(None)
+
+        pool_tasks = [asyncio.create_task(feed_accounts())]
+        pool_tasks += [asyncio.create_task(work_accounts()) for _ in range(self.workers)]
+        workers_running = self.workers
+        try:
+            while workers_running:
+                result = await result_queue.get()
+                if result is None:
+                    workers_running -= 1
+                    continue
+                yield result
+        finally:
+            for task in pool_tasks:
+                task.cancel()
+            # Wait for in-flight accounts to unwind, so none is left holding an API slot or the breaker's probe.
+            await asyncio.gather(*pool_tasks, return_exceptions=True)
 
-                else:
-                    error_detail = f"API Error ({response.status})"
+# --- Job Checkpoints ---
+
+class JobCheckpoint:
+    """
+    On-disk progress of one batch in JOBS_DIR/<key>/, so a restart or redeploy doesn't lose it:
+    job.json describes the job, input.json holds a manual upload and results.jsonl gets one line
+    per finished input item, keyed by the item's index in the file. On resume, items with a line
+    are restored instead of sent to the API again; tokens that are close to expiry by then
+    (TOKEN_CACHE_MIN_REMAINING) and accounts skipped while the API was down are redone.
+    Scheduled runs keep their checkpoint after finishing, compacted to the successful results,
+    and the next run loads it in incremental mode (see load_results).
+    """
+
+    META_FILE_NAME = 'job.json'
+    INPUT_FILE_NAME = 'input.json'
+    RESULTS_FILE_NAME = 'results.jsonl'
+
+    def __init__(self, key: str):
+        self.key = key
+        self.dir = os.path.join(JOBS_DIR, key)
+        self.meta_path = os.path.join(self.dir, self.META_FILE_NAME)
+        self.input_path = os.path.join(self.dir, self.INPUT_FILE_NAME)
+        self.results_path = os.path.join(self.dir, self.RESULTS_FILE_NAME)
+        self._done: dict[int, tuple[str | None, str | None, str | None]] = {}
+        self._logged: set[int] = set()
+        self._results_file = None
+        self.restored_count = 0
+
+    def load_meta(self) -> dict | None:
+        if not os.path.exists(self.meta_path):
+            return None
+        meta = load_json_data(self.meta_path, {})
+        return meta if isinstance(meta, dict) and meta else None
+
+    def save_meta(self, meta: dict) -> bool:
+        return save_json_data(self.meta_path, meta)
+
+    def load_results(self, incremental_min_remaining: float | None = None) -> int:
+        """
+        Reads results.jsonl from an earlier run. Returns how many items can be restored.
+        With incremental_min_remaining set (a finished previous run), only tokens known to stay
+        valid for at least that many more seconds are restored; failed accounts are redone.
+        """
+        self._done.clear()
+        self._logged.clear()
+        if not os.path.exists(self.results_path):
+            return 0
+        incremental = incremental_min_remaining is not None
+        min_expiry = time.time() + (incremental_min_remaining if incremental else TOKEN_CACHE_MIN_REMAINING)
+        try:
+            with open(self.results_path, 'r', encoding='utf-8') as f:
+                for line in f:
                     try:
-                        error_json = json.loads(response_text)
-                        if isinstance(error_json, dict):
-                            msg = error_json.get('message') or error_json.get('error') or error_json.get('detail')
-                            if msg and isinstance(msg, str):
-                                error_detail += f": {msg[:100]}"
-                    except (json.JSONDecodeError, TypeError): pass
-
-                    logger.warning(f"API Error for UID: {uid_str}. Status: {response.status}. Detail: {error_detail}. Raw Response: {response_text[:200]}")
-                    lost_info = {**original_account_info, "error_reason": error_detail}
-                    return None, None, None, lost_info, error_detail
-
-        except asyncio.TimeoutError:
-             logger.warning(f"Timeout processing API request for UID: {uid_str}")
-             error_reason = "Request Timeout"
-             lost_info = {**original_account_info, "error_reason": error_reason}
-             return None, None, None, lost_info, error_reason
-        except aiohttp.ClientConnectorError as e:
-             logger.error(f"Network Connection Error processing UID {uid_str}: {e}")
-             error_reason = f"Network Error: {e}"
-             lost_info = {**original_account_info, "error_reason": error_reason}
-             return None, None, None, lost_info, error_reason
-        except aiohttp.ClientError as e:
-             logger.error(f"AIOHTTP Client Error processing UID {uid_str}: {e}")
-             error_reason = f"HTTP Client Error: {e}"
-             lost_info = {**original_account_info, "error_reason": error_reason}
-             return None, None, None, lost_info, error_reason
-        except Exception as e:
-             logger.error(f"Unexpected error processing UID {uid_str}: {e}", exc_info=True)
-             error_reason = f"Unexpected Processing Error: {e}"
-             lost_info = {**original_account_info, "error_reason": error_reason}
-             return None, None, None, lost_info, error_reason
+                        record = json.loads(line)
+                        index = int(record['i'])
+                    except (ValueError, KeyError, TypeError):
+                        continue  # A line cut short by the crash
+                    token, error_reason = record.get('token'), record.get('error')
+                    if token:
+                        expiry = decode_jwt_expiry(token)
+                        if (expiry is None and incremental) or (expiry is not None and expiry < min_expiry):
+                            self._done.pop(index, None)
+                            continue
+                    elif incremental or error_reason == UPSTREAM_UNAVAILABLE_REASON:
+                        self._done.pop(index, None)
+                        continue
+                    self._done[index] = (token, record.get('region'), error_reason)
+        except OSError as e:
+            logger.error(f"Could not read checkpoint {self.results_path}: {e}. Starting over.")
+            self._done.clear()
+        self._logged.update(self._done)
+        return len(self._done)
+
+    def restore(self, index: int, item) -> AccountResult | None:
+        """Returns the checkpointed result for the item at index, or None if it still has to be processed."""
+        done = self._done.pop(index, None)
+        if done is None:
+            return None
+        token, region, error_reason = done
+        account = item if isinstance(item, dict) else {"account_info": item}
+        self.restored_count += 1
+        if token:
+            return AccountResult(account, token=token, region=region)
+        return AccountResult.lost(account, error_reason or "Unknown Failure")
+
+    def record(self, result: AccountResult) -> None:
+        """Appends a finished item to results.jsonl. Restored items are already there."""
+        if result.index is None or result.index in self._logged:
+            return
+        if result.token:
+            record = {"i": result.index, "token": result.token, "region": result.region}
+        else:
+            record = {"i": result.index, "error": result.error_reason}
+        try:
+            if self._results_file is None:
+                os.makedirs(self.dir, exist_ok=True)
+                self._results_file = open(self.results_path, 'a', encoding='utf-8')
+            self._results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._results_file.flush()
+        except OSError as e:
+            logger.warning(f"Could not write checkpoint {self.results_path}: {e}")
+
+    def compact(self) -> bool:
+        """Rewrites results.jsonl with only the latest successful result of each item."""
+        self.close()
+        if not os.path.exists(self.results_path):
+            return True
+        latest_lines: dict[int, str] = {}
+        temp_path = self.results_path + '.tmp'
+        try:
+            with open(self.results_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        index = int(record['i'])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    if record.get('token'):
+                        latest_lines[index] = line if line.endswith("\n") else line + "\n"
+                    else:
+                        latest_lines.pop(index, None)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.writelines(latest_lines.values())
+            os.replace(temp_path, self.results_path)
+            return True
+        except OSError as e:
+            logger.error(f"Could not compact checkpoint {self.results_path}: {e}")
+            return False
+
+    def indexed_items(self, items):
+        """Numbers items for AccountWorkerPool, replacing those finished in an earlier run with their result."""
+        for index, item in enumerate(items):
+            restored = self.restore(index, item) if self._done else None
+            yield index, restored or item
+
+    def close(self) -> None:
+        if self._results_file is not None:
+            try:
+                self._results_file.close()
+            except OSError:
+                pass
+            self._results_file = None
+
+    def discard(self) -> None:
+        """Deletes the checkpoint once the job's results have been delivered."""
+        self.close()
+        if os.path.exists(self.dir):
+            try:
+                shutil.rmtree(self.dir)
+            except OSError as e:
+                logger.warning(f"Could not remove checkpoint directory {self.dir}: {e}")
+
+def schedule_checkpoint(stored_file_path: str) -> JobCheckpoint:
+    """Checkpoint of a scheduled file, keyed by its stored file name (unique per schedule and rotation file)."""
+    return JobCheckpoint(f"schedule_{ntpath.basename(stored_file_path)}")
+
+# --- Manual Job Queue ---
+
+class ManualJob:
+    """A queued manual upload. Only plain identifiers are kept, so a job can be written to disk."""
+
+    def __init__(self, user_id: int, chat_id: int, message_id: int, file_id: str, file_name: str,
+                 user_first_name: str = '', username: str = '', job_id: str | None = None, created_at: float | None = None):
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.file_id = file_id
+        self.file_name = file_name
+        self.user_first_name = user_first_name
+        self.username = username
+        self.created_at = created_at or time.time()
+        self.started_at = None
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": "manual", "job_id": self.job_id, "user_id": self.user_id, "chat_id": self.chat_id,
+            "message_id": self.message_id, "file_id": self.file_id, "file_name": self.file_name,
+            "user_first_name": self.user_first_name, "username": self.username, "created_at": self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ManualJob":
+        return cls(
+            user_id=int(data['user_id']), chat_id=int(data['chat_id']), message_id=int(data['message_id']),
+            file_id=data['file_id'], file_name=data['file_name'],
+            user_first_name=data.get('user_first_name', ''), username=data.get('username', ''),
+            job_id=data['job_id'], created_at=data.get('created_at')
+        )
+
+class ManualJobQueue:
+    """
+    FIFO queue of manual jobs, run by MAX_CONCURRENT_MANUAL_JOBS workers.
+    Each user may have only one job queued or running at a time.
+    """
+
+    def __init__(self):
+        self.pending: deque[ManualJob] = deque()
+        self.running: dict[str, ManualJob] = {}
+        self._by_user: dict[int, ManualJob] = {}
+        self._available = asyncio.Event()
+
+    def active_job_for(self, user_id: int) -> ManualJob | None:
+        return self._by_user.get(user_id)
+
+    def position(self, job: ManualJob) -> int:
+        """1-based position among pending jobs, or 0 if the job is running or unknown."""
+        for index, pending_job in enumerate(self.pending):
+            if pending_job is job:
+                return index + 1
+        return 0
+
+    def submit(self, job: ManualJob) -> int:
+        self.pending.append(job)
+        self._by_user[job.user_id] = job
+        self._available.set()
+        return len(self.pending)
+
+    async def next_job(self) -> ManualJob:
+        while not self.pending:
+            self._available.clear()
+            await self._available.wait()
+        job = self.pending.popleft()
+        job.started_at = time.time()
+        self.running[job.job_id] = job
+        return job
+
+    def finish(self, job: ManualJob) -> None:
+        self.running.pop(job.job_id, None)
+        if self._by_user.get(job.user_id) is job:
+            del self._by_user[job.user_id]
+
+manual_jobs = ManualJobQueue()
+
+async def resume_checkpointed_jobs(bot) -> int:
+    """Re-queues manual jobs that were interrupted by a restart. Returns how many were queued."""
+    if not os.path.isdir(JOBS_DIR):
+        return 0
+    interrupted = []
+    for entry in os.listdir(JOBS_DIR):
+        checkpoint = JobCheckpoint(entry)
+        meta = checkpoint.load_meta()
+        if not meta or meta.get('kind') != 'manual':
+            continue  # Scheduled runs pick up their checkpoint when the scheduler runs them again
+        try:
+            interrupted.append(ManualJob.from_dict(meta))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Discarding unreadable job checkpoint {checkpoint.dir}: {e}")
+            checkpoint.discard()
+
+    for job in sorted(interrupted, key=lambda job: job.created_at):
+        position = manual_jobs.submit(job)
+        logger.info(f"Resuming manual job #{job.job_id} for user {job.user_id} ('{job.file_name}') at queue position {position}.")
+        try:
+            await bot.send_message(job.chat_id, f"♻️ The bot restarted while job `#{job.job_id}` (`{escape(job.file_name)}`) was pending. It has been queued again and will continue where it left off.", parse_mode=ParseMode.MARKDOWN)
+        except TelegramError as e:
+            logger.warning(f"Could not notify user {job.user_id} about resumed job #{job.job_id}: {e}")
+    return len(interrupted)
 
 async def handle_document(update: Update, context: CallbackContext) -> None:
     """Handle incoming JSON documents OR files sent after /setfile."""
@@ -621,68 +2324,113 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
         )
         return
 
-    temp_file_path = os.path.join(TEMP_DIR, f'input_manual_{user_id}_{int(time.time())}.json')
+    active_job = manual_jobs.active_job_for(user_id)
+    if active_job:
+        job_state = "running" if active_job.job_id in manual_jobs.running else f"queued at position {manual_jobs.position(active_job)}"
+        await message.reply_text(
+            f"⏳ You already have a job (`#{active_job.job_id}`) {job_state}. Please wait for it to finish before sending another file.",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=main_reply_markup
+        )
+        return
+    if len(manual_jobs.pending) >= MAX_QUEUED_MANUAL_JOBS:
+        await message.reply_text("⚠️ The processing queue is full right now. Please try again in a few minutes.", reply_markup=main_reply_markup)
+        return
+
+    job = ManualJob(
+        user_id=user_id, chat_id=chat_id, message_id=message.message_id,
+        file_id=file_id, file_name=file_name,
+        user_first_name=user.first_name or '', username=user.username or ''
+    )
+    if not JobCheckpoint(job.job_id).save_meta(job.to_dict()):
+        logger.warning(f"Could not checkpoint manual job #{job.job_id}; it won't survive a restart.")
+    position = manual_jobs.submit(job)
+    logger.info(f"User {user_id} queued manual job #{job.job_id} for '{file_name}' at position {position}.")
+    await message.reply_text(
+        f"📥 Job `#{job.job_id}` queued for `{escape(file_name)}`.\n"
+        f"Position in queue: {position} ({len(manual_jobs.running)}/{MAX_CONCURRENT_MANUAL_JOBS} jobs running).\n"
+        f"You'll get progress updates here once it starts.",
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=main_reply_markup
+    )
+
+async def run_manual_job(bot, job: ManualJob) -> None:
+    """Downloads, processes and returns results for one queued manual upload."""
+    user_id = job.user_id
+    file_id = job.file_id
+    file_name = job.file_name
+
+    checkpoint = JobCheckpoint(job.job_id)
+    temp_file_path = checkpoint.input_path
     progress_message = None
-    accounts_data = []
+    input_file = None
+    account_stream = None
+    first_account = None
+    input_ready = False
 
     try:
         os.makedirs(TEMP_DIR, exist_ok=True)
-        progress_message = await message.reply_text(f"⏳ Downloading `{escape(file_name)}` for manual processing...", parse_mode=ParseMode.MARKDOWN)
+        if os.path.exists(temp_file_path):
+            progress_message = await bot.send_message(job.chat_id, f"⏳ Job `#{job.job_id}` resumed. Reading `{escape(file_name)}` again...", parse_mode=ParseMode.MARKDOWN)
+            logger.info(f"Resuming manual job #{job.job_id} for user {user_id} from {temp_file_path}")
+        else:
+            os.makedirs(checkpoint.dir, exist_ok=True)
+            progress_message = await bot.send_message(job.chat_id, f"⏳ Job `#{job.job_id}` started. Downloading `{escape(file_name)}` for manual processing...", parse_mode=ParseMode.MARKDOWN)
 
-        bot_file = await context.bot.get_file(file_id)
-        await bot_file.download_to_drive(temp_file_path)
-        logger.info(f"User {user_id} uploaded file '{file_name}' for manual processing, downloaded to {temp_file_path}")
+            bot_file = await bot.get_file(file_id)
+            await bot_file.download_to_drive(temp_file_path + '.part')
+            os.replace(temp_file_path + '.part', temp_file_path)
+            logger.info(f"User {user_id} uploaded file '{file_name}' for manual processing, downloaded to {temp_file_path}")
 
-        await context.bot.edit_message_text(
-            chat_id=progress_message.chat_id, message_id=progress_message.message_id,
-            text=f"⏳ Downloaded `{escape(file_name)}`. Parsing JSON...", parse_mode=ParseMode.MARKDOWN
-        )
+            await bot.edit_message_text(
+                chat_id=progress_message.chat_id, message_id=progress_message.message_id,
+                text=f"⏳ Downloaded `{escape(file_name)}`. Parsing JSON...", parse_mode=ParseMode.MARKDOWN
+            )
 
         actual_size = os.path.getsize(temp_file_path)
         if actual_size > MAX_FILE_SIZE:
              raise ValueError(f"Downloaded file size ({actual_size / 1024 / 1024:.2f} MB) exceeds limit ({MAX_FILE_SIZE / 1024 / 1024:.1f} MB).")
 
-        with open(temp_file_path, 'r', encoding='utf-8') as f:
-            try:
-                accounts_data = json.load(f)
-            except json.JSONDecodeError as e:
-                error_line_info = ""
-                if hasattr(e, 'lineno') and hasattr(e, 'colno'):
-                    error_line_info = f" near line {e.lineno}, column {e.colno}"
-                error_msg = f"❌ Invalid JSON format in `{escape(file_name)}`{error_line_info}.\nError: `{escape(e.msg)}`.\nPlease check the file structure and syntax."
-                await context.bot.edit_message_text(
-                    chat_id=progress_message.chat_id, message_id=progress_message.message_id,
-                    text=error_msg, parse_mode=ParseMode.MARKDOWN
-                )
-                if ADMIN_ID and ADMIN_ID != 0:
-                    try:
-                        await context.bot.send_message(ADMIN_ID, f"⚠️ User {user.id} uploaded invalid JSON for manual processing: `{escape(file_name)}`. Error: {escape(e.msg)}{error_line_info}")
-                    except Exception as forward_e:
-                        logger.error(f"Failed to forward invalid JSON notice to admin {ADMIN_ID}: {forward_e}")
-                return
+        input_file = open(temp_file_path, 'r', encoding='utf-8')
+        account_stream = iter_json_array(input_file)
+        try:
+            first_account = next(account_stream, None)
+        except json.JSONDecodeError as e:
+            error_line_info = ""
+            if hasattr(e, 'lineno') and hasattr(e, 'colno'):
+                error_line_info = f" near line {e.lineno}, column {e.colno}"
+            error_msg = f"❌ Invalid JSON format in `{escape(file_name)}`{error_line_info}.\nError: `{escape(e.msg)}`.\nPlease check the file structure and syntax."
+            await bot.edit_message_text(
+                chat_id=progress_message.chat_id, message_id=progress_message.message_id,
+                text=error_msg, parse_mode=ParseMode.MARKDOWN
+            )
+            if ADMIN_ID and ADMIN_ID != 0:
+                try:
+                    await bot.send_message(ADMIN_ID, f"⚠️ User {user_id} uploaded invalid JSON for manual processing: `{escape(file_name)}`. Error: {escape(e.msg)}{error_line_info}")
+                except Exception as forward_e:
+                    logger.error(f"Failed to forward invalid JSON notice to admin {ADMIN_ID}: {forward_e}")
+            return
 
-        if not isinstance(accounts_data, list):
-            raise ValueError("Input JSON structure is invalid. It must be an array (a list `[...]`) of objects.")
-        if accounts_data and not all(isinstance(item, dict) for item in accounts_data):
-             first_bad_item = next((item for item in accounts_data if not isinstance(item, dict)), None)
-             raise ValueError(f"All items inside the JSON array must be objects (`{{...}}`). Found an item that is not an object: `{escape(str(first_bad_item)[:50])}`...")
+        if first_account is not None and not isinstance(first_account, dict):
+             raise ValueError(f"All items inside the JSON array must be objects (`{{...}}`). Found an item that is not an object: `{escape(str(first_account)[:50])}`...")
+        input_ready = first_account is not None
 
     except ValueError as e:
         logger.warning(f"Input file validation failed for user {user_id} ('{file_name}'): {e}")
         error_text = f"❌ Validation Error: {escape(str(e))}"
         if progress_message:
-             await context.bot.edit_message_text(chat_id=progress_message.chat_id, message_id=progress_message.message_id, text=error_text, parse_mode=ParseMode.MARKDOWN)
+             await bot.edit_message_text(chat_id=progress_message.chat_id, message_id=progress_message.message_id, text=error_text, parse_mode=ParseMode.MARKDOWN)
         else:
-             await message.reply_text(error_text, reply_markup=main_reply_markup, parse_mode=ParseMode.MARKDOWN)
+             await bot.send_message(job.chat_id, error_text, reply_markup=main_reply_markup, parse_mode=ParseMode.MARKDOWN)
         return
     except TelegramError as e:
         logger.error(f"Telegram API error during file handling for user {user_id}: {e}")
         try:
             error_text = f"⚠️ A Telegram error occurred: `{escape(str(e))}`. Please try again later."
             if progress_message:
-                await context.bot.edit_message_text(chat_id=progress_message.chat_id, message_id=progress_message.message_id, text=error_text, parse_mode=ParseMode.MARKDOWN)
+                await bot.edit_message_text(chat_id=progress_message.chat_id, message_id=progress_message.message_id, text=error_text, parse_mode=ParseMode.MARKDOWN)
             else:
-                 await message.reply_text(error_text, reply_markup=main_reply_markup, parse_mode=ParseMode.MARKDOWN)
+                 await bot.send_message(job.chat_id, error_text, reply_markup=main_reply_markup, parse_mode=ParseMode.MARKDOWN)
         except TelegramError:
             logger.error(f"Could not inform user {user_id} about Telegram error: {e}")
         return
@@ -691,106 +2439,94 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
         error_text = f"⚠️ An unexpected error occurred while handling the file. Please try again or contact admin if it persists."
         if progress_message:
             try:
-                await context.bot.edit_message_text(chat_id=progress_message.chat_id, message_id=progress_message.message_id, text=error_text)
+                await bot.edit_message_text(chat_id=progress_message.chat_id, message_id=progress_message.message_id, text=error_text)
             except TelegramError:
-                await message.reply_text(error_text, reply_markup=main_reply_markup)
+                await bot.send_message(job.chat_id, error_text, reply_markup=main_reply_markup)
         else:
-            await message.reply_text(error_text, reply_markup=main_reply_markup)
+            await bot.send_message(job.chat_id, error_text, reply_markup=main_reply_markup)
         return
     finally:
-        if os.path.exists(temp_file_path):
-             try:
-                 os.remove(temp_file_path)
-             except OSError as e:
-                 logger.warning(f"Could not remove temp input file {temp_file_path}: {e}")
+        if not input_ready and input_file:
+            input_file.close()
 
-    total_count = len(accounts_data)
-    if total_count == 0:
-        await context.bot.edit_message_text(
+    if first_account is None:
+        await bot.edit_message_text(
             chat_id=progress_message.chat_id, message_id=progress_message.message_id,
             text="ℹ️ The provided JSON file is empty or contains no valid account objects."
         )
         return
 
-    await context.bot.edit_message_text(
+    await bot.edit_message_text(
         chat_id=progress_message.chat_id, message_id=progress_message.message_id,
-        text=f"🔄 *Processing {total_count} Accounts (Manual)*\nInitializing API calls (max {MAX_CONCURRENT_REQUESTS} parallel)...",
+        text=f"🔄 *Processing `{escape(file_name)}` (Manual)*\nInitializing API calls (adaptive, currently {api_limiter.limit} parallel across all jobs)...",
         parse_mode=ParseMode.MARKDOWN
     )
 
     start_time = time.time()
     processed_count = 0
-    successful_tokens = []
-    lost_accounts = []
     errors_summary = defaultdict(int)
-    successful_by_region = defaultdict(list)
-    working_by_region = defaultdict(list)
-
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-    async with aiohttp.ClientSession() as session:
-        tasks = [process_account(session, account, semaphore) for account in accounts_data]
-        last_update_time = time.time()
-        last_progress_text_sent = ""
-
-        for future in asyncio.as_completed(tasks):
-            try:
-                token, region, working_acc, lost_acc, error_reason = await future
-            except Exception as task_err:
-                logger.error(f"Error retrieving result from processing task: {task_err}", exc_info=True)
-                error_msg = f"Internal task error: {task_err}"
-                lost_accounts.append({"account_info": "unknown", "error_reason": error_msg})
-                errors_summary[error_msg] += 1
-                processed_count += 1
-                continue
+    results_dir = os.path.join(TEMP_DIR, f'results_{user_id}_{int(start_time)}')
+    results = JobResults(results_dir, stream_to_disk=os.path.getsize(temp_file_path) > RESULTS_TO_DISK_THRESHOLD)
+
+    # Accounts are parsed from the file as the workers take them, so API calls start
+    # right away and only about 2 * ACCOUNT_WORKERS_PER_JOB parsed accounts are held at once.
+    # Every finished account is appended to the job's checkpoint, so after a restart only
+    # the accounts without a result there are sent to the API again.
+    restorable_count = checkpoint.load_results()
+    if restorable_count:
+        logger.info(f"Manual job #{job.job_id}: restoring {restorable_count} results from checkpoint.")
+    session = get_http_session(API_BASE_URL)
+    retry_budget = RetryBudget()
+    deduplicator = AccountDeduplicator()
+    pool = AccountWorkerPool(session, user_id, retry_budget)
+    account_stream = (item for item in itertools.chain((first_account,), account_stream)
+                      if not isinstance(item, dict) or deduplicator.admit(item))
+    pool_results = pool.results(checkpoint.indexed_items(account_stream))
+    last_update_time = time.time()
+    last_progress_text_sent = ""
 
+    try:
+        async for result in pool_results:
             processed_count += 1
-
-            if token and working_acc:
-                region_name = region if region else "Unknown"
-                successful_tokens.append({"token": token, "region": region_name})
-                successful_by_region[region_name].append({"token": token})
-                working_by_region[region_name].append(working_acc)
-            elif lost_acc:
-                lost_accounts.append(lost_acc)
-                reason = lost_acc.get("error_reason", "Unknown Failure")
-                simple_error = reason.split(':')[0].strip()
-                errors_summary[simple_error] += 1
-            else:
-                 logger.error(f"Task completed unexpectedly. Token:{token}, Region:{region}, Work:{working_acc}, Lost:{lost_acc}, Err:{error_reason}")
-                 generic_lost_info = {"account_info": lost_acc or working_acc or "unknown", "error_reason": "Processing function returned unexpected state"}
-                 lost_accounts.append(generic_lost_info)
-                 errors_summary["Processing function error"] += 1
+            results.add(result)
+            checkpoint.record(result)
+            if not result.token:
+                reason = result.error_reason or "Unknown Failure"
+                errors_summary[reason.split(':')[0].strip()] += 1
 
             current_time = time.time()
-            update_frequency_items = max(10, min(100, total_count // 10))
+            update_frequency_items = max(10, min(100, pool.submitted // 10))
             time_elapsed_since_last_update = current_time - last_update_time;
 
             if time_elapsed_since_last_update > 2.0 or \
                (update_frequency_items > 0 and processed_count % update_frequency_items == 0) or \
-               processed_count == total_count:
+               (pool.input_done and processed_count == pool.submitted):
 
                 elapsed_time = current_time - start_time
-                percentage = (processed_count / total_count) * 100 if total_count > 0 else 0
+                percentage = (processed_count / pool.submitted) * 100 if pool.submitted > 0 else 0
 
                 estimated_remaining_time = -1
-                if processed_count > 5 and elapsed_time > 2:
+                if pool.input_done and processed_count > 5 and elapsed_time > 2:
                     try:
                         time_per_item = elapsed_time / processed_count
-                        remaining_items = total_count - processed_count
+                        remaining_items = pool.submitted - processed_count
                         estimated_remaining_time = time_per_item * remaining_items
                     except ZeroDivisionError: pass
 
+                progress_line = f"Progress: {processed_count}/{pool.submitted} ({percentage:.1f}%)" if pool.input_done else f"Progress: {processed_count}/{pool.submitted}+ (still reading file)"
                 progress_text = (
                     f"🔄 *Processing Accounts (Manual)...*\n\n"
-                    f"Progress: {processed_count}/{total_count} ({percentage:.1f}%)\n"
-                    f"✅ Success: {len(successful_tokens)} | ❌ Failed: {len(lost_accounts)}\n"
+                    f"{progress_line}\n"
+                    f"✅ Success: {results.success_count} | ❌ Failed: {results.lost_count}\n"
                     f"⏱️ Elapsed: {format_time(elapsed_time)}\n"
                     f"⏳ Est. Remaining: {format_time(estimated_remaining_time)}"
                 )
+                if api_breaker.state != CircuitBreaker.CLOSED:
+                    progress_text += "\n\n⚠️ The token API is not responding. Remaining accounts are failing fast; re-send `lost_account.json` later."
 
                 if last_progress_text_sent != progress_text:
                     try:
-                        await context.bot.edit_message_text(
+                        await bot.edit_message_text(
                             chat_id=progress_message.chat_id, message_id=progress_message.message_id,
                             text=progress_text, parse_mode=ParseMode.MARKDOWN
                         )
@@ -801,21 +2537,44 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
                              logger.warning(f"Could not edit progress message: {edit_err}")
                         last_update_time = current_time
 
+    finally:
+        await pool_results.aclose()
+        input_file.close()
+        checkpoint.close()
+
+    total_count = pool.submitted
     final_elapsed_time = time.time() - start_time
     escaped_file_name = escape(file_name)
     final_summary_parts = [
         f"🏁 *Manual Processing Complete for `{escaped_file_name}`*\n",
         f"📊 Total Accounts Processed: {total_count}",
-        f"✅ Successful Tokens: {len(successful_tokens)}",
-        f"❌ Failed/Invalid Accounts: {len(lost_accounts)}",
+        f"✅ Successful Tokens: {results.success_count}",
+        f"🔁 Succeeded After Retry: {retry_budget.retried_successes}",
+        f"❌ Failed/Invalid Accounts: {results.lost_count}",
+        f"♻️ Duplicates Skipped: {deduplicator.duplicates_removed} (API calls saved)",
         f"⏱️ Total Time Taken: {format_time(final_elapsed_time)}"
     ]
-
-    if successful_by_region:
+    if checkpoint.restored_count:
+        final_summary_parts.insert(4, f"💾 Restored From Before Restart: {checkpoint.restored_count}")
+    parse_error = pool.input_error
+    if parse_error:
+        stop_point = f" at line {parse_error.lineno}, column {parse_error.colno}" if isinstance(parse_error, json.JSONDecodeError) else ""
+        final_summary_parts.append(f"⚠️ Stopped reading the file{stop_point}: `{escape(str(getattr(parse_error, 'msg', parse_error)))}`. Only the accounts before that point were processed.")
+    conflicting_uids = deduplicator.conflicting_uids
+    if conflicting_uids:
+        shown_uids = ", ".join(f"`{escape(uid)}`" for uid in conflicting_uids[:5])
+        more_uids = f" and {len(conflicting_uids) - 5} more" if len(conflicting_uids) > 5 else ""
+        final_summary_parts.append(f"⚠️ {len(conflicting_uids)} UIDs appear with different passwords: {shown_uids}{more_uids}")
+    if retry_budget.exhausted:
+        final_summary_parts.append("⚠️ Retry budget used up; remaining transient failures were not retried.")
+    if errors_summary.get(UPSTREAM_UNAVAILABLE_REASON):
+        final_summary_parts.append(f"⚠️ {errors_summary[UPSTREAM_UNAVAILABLE_REASON]} accounts were skipped because the token API was down. Re-send `lost_account.json` later.")
+
+    if results.region_counts:
         final_summary_parts.append("\n*Successful by Region:*")
-        sorted_regions = sorted(successful_by_region.keys())
+        sorted_regions = sorted(results.region_counts.keys())
         for region in sorted_regions:
-            count = len(successful_by_region[region])
+            count = results.region_counts[region]
             final_summary_parts.append(f"- {escape(region)}: {count} tokens")
     else:
         final_summary_parts.append("\n*Successful by Region:* 0 tokens found.")
@@ -832,8 +2591,9 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
 
     try:
         if progress_message:
-            await context.bot.delete_message(chat_id=progress_message.chat_id, message_id=progress_message.message_id)
-        await message.reply_text(
+            await bot.delete_message(chat_id=progress_message.chat_id, message_id=progress_message.message_id)
+        await bot.send_message(
+            job.chat_id,
             final_summary,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=main_reply_markup
@@ -841,7 +2601,8 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
     except TelegramError as final_msg_err:
         logger.error(f"Could not delete progress message or send final summary: {final_msg_err}. Progress message ID: {progress_message.message_id if progress_message else 'N/A'}")
         try:
-            await message.reply_text(
+            await bot.send_message(
+                job.chat_id,
                 final_summary,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=main_reply_markup
@@ -849,84 +2610,27 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
         except Exception as fallback_err:
             logger.critical(f"Failed even fallback sending final summary for manual process: {fallback_err}")
 
-    file_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_files_to_send = []
-    cleanup_paths = []
+    cleanup_paths = [results_dir]
     jwt_token_path_for_upload = None
 
     try:
-        os.makedirs(TEMP_DIR, exist_ok=True)
-
-        if successful_tokens:
-            jwt_token_path = os.path.join(TEMP_DIR, f'jwt_only_{user_id}_{file_timestamp}.json')
-            tokens_only_list_for_file = [{"token": entry.get("token")} for entry in successful_tokens if entry.get("token")]
-
-            if tokens_only_list_for_file:
-                if save_json_data(jwt_token_path, tokens_only_list_for_file):
-                    output_files_to_send.append((jwt_token_path, 'all_server_token.json'))
-                    cleanup_paths.append(jwt_token_path)
-                    jwt_token_path_for_upload = jwt_token_path
-                else:
-                    await message.reply_text("⚠️ Error saving main `all_server_token.json` to temporary storage.")
-
-        if successful_by_region:
-            logger.info(f"Creating region-specific token files for user {user_id}")
-            for region_name, entries in successful_by_region.items():
-                if not entries: continue
-
-                region_tokens_only = [{"token": entry.get("token")} for entry in entries if entry.get("token")]
-
-                if region_tokens_only:
-                    sanitized_region_name = sanitize_filename(region_name)
-                    base_region_name = os.path.splitext(sanitized_region_name)[0]
-                    region_file_name = f'token_{base_region_name}.json'
-
-                    region_file_path = os.path.join(TEMP_DIR, f'{base_region_name}_{user_id}_{file_timestamp}.json')
-
-                    if save_json_data(region_file_path, region_tokens_only):
-                        output_files_to_send.append((region_file_path, region_file_name))
-                        cleanup_paths.append(region_file_path)
-                        logger.debug(f"Created region token file: {region_file_name} with {len(region_tokens_only)} tokens.")
-                    else:
-                        await message.reply_text(f"⚠️ Error saving region token file `{escape(region_file_name)}` to temporary storage.", parse_mode=ParseMode.MARKDOWN)
-
-        if working_by_region:
-            logger.info(f"Creating region-specific account files for user {user_id}")
-            for region_name, entries in working_by_region.items():
-                if not entries: continue
-
-                sanitized_region_name = sanitize_filename(region_name)
-                base_region_name = os.path.splitext(sanitized_region_name)[0]
-                account_file_name = f'account_{base_region_name}.json'
-
-                account_file_path = os.path.join(TEMP_DIR, f'account_{base_region_name}_{user_id}_{file_timestamp}.json')
-
-                if save_json_data(account_file_path, entries):
-                    output_files_to_send.append((account_file_path, account_file_name))
-                    cleanup_paths.append(account_file_path)
-                    logger.debug(f"Created region account file: {account_file_name} with {len(entries)} accounts.")
-                else:
-                    await message.reply_text(f"⚠️ Error saving region account file `{escape(account_file_name)}` to temporary storage.", parse_mode=ParseMode.MARKDOWN)
-
-        if lost_accounts:
-            lost_account_path = os.path.join(TEMP_DIR, f'lost_{user_id}_{file_timestamp}.json')
-            if save_json_data(lost_account_path, lost_accounts):
-                output_files_to_send.append((lost_account_path, 'lost_account.json'))
-                cleanup_paths.append(lost_account_path)
-            else:
-                await message.reply_text("⚠️ Error saving `lost_account.json` to temporary storage.")
+        output_files_to_send, failed_file_names = results.write_files()
+        for failed_name in failed_file_names:
+            await bot.send_message(job.chat_id, f"⚠️ Error saving `{escape(failed_name)}` to temporary storage.", parse_mode=ParseMode.MARKDOWN)
+        if results.TOKEN_FILE_NAME not in failed_file_names:
+            jwt_token_path_for_upload = results.token_file_path
 
         if output_files_to_send:
-            await message.reply_text(f"⬇️ Sending {len(output_files_to_send)} result file(s)...")
-            output_files_to_send.sort(key=lambda x: x[1])
+            await bot.send_message(job.chat_id, f"⬇️ Sending {len(output_files_to_send)} result file(s)...")
             for temp_path, desired_filename in output_files_to_send:
                  if not os.path.exists(temp_path):
                      logger.error(f"Output file {temp_path} (for {desired_filename}) not found before sending.")
-                     await message.reply_text(f"⚠️ Internal Error: Could not find `{escape(desired_filename)}` for sending.", parse_mode=ParseMode.MARKDOWN)
+                     await bot.send_message(job.chat_id, f"⚠️ Internal Error: Could not find `{escape(desired_filename)}` for sending.", parse_mode=ParseMode.MARKDOWN)
                      continue
                  try:
                      with open(temp_path, 'rb') as f:
-                         await message.reply_document(
+                         await bot.send_document(
+                             job.chat_id,
                              document=InputFile(f, filename=desired_filename),
                              caption=f"`{escape(desired_filename)}`\nFrom manual processing of: `{escaped_file_name}`\nTotal Processed: {total_count}",
                              parse_mode=ParseMode.MARKDOWN
@@ -935,12 +2639,12 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
                      await asyncio.sleep(0.5)
                  except TelegramError as send_err:
                      logger.error(f"Failed to send '{desired_filename}' to user {user_id}: {send_err}")
-                     await message.reply_text(f"⚠️ Failed to send `{escape(desired_filename)}`: {escape(str(send_err))}", parse_mode=ParseMode.MARKDOWN)
+                     await bot.send_message(job.chat_id, f"⚠️ Failed to send `{escape(desired_filename)}`: {escape(str(send_err))}", parse_mode=ParseMode.MARKDOWN)
                  except Exception as general_err:
                      logger.error(f"Unexpected error sending '{desired_filename}' to {user_id}: {general_err}", exc_info=True)
-                     await message.reply_text(f"⚠️ Unexpected error sending `{escape(desired_filename)}`.", parse_mode=ParseMode.MARKDOWN)
+                     await bot.send_message(job.chat_id, f"⚠️ Unexpected error sending `{escape(desired_filename)}`.", parse_mode=ParseMode.MARKDOWN)
         elif total_count > 0:
-             await message.reply_text("ℹ️ No output files were generated (e.g., 0 successful tokens found or error saving files).", reply_markup=main_reply_markup)
+             await bot.send_message(job.chat_id, "ℹ️ No output files were generated (e.g., 0 successful tokens found or error saving files).", reply_markup=main_reply_markup)
 
         if is_user_vip(user_id) and jwt_token_path_for_upload:
             github_configs = load_github_configs()
@@ -951,54 +2655,55 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
                 logger.info(f"User {user_id} is VIP with GitHub config. Attempting auto-upload (manual process).")
                 if os.path.exists(jwt_token_path_for_upload):
                     await upload_to_github_background(
-                        context.bot,
+                        bot,
                         user_id,
                         jwt_token_path_for_upload,
                         config
                         )
                 else:
                      logger.error(f"JWT file {jwt_token_path_for_upload} missing for GitHub upload (user {user_id}). Logic error?")
-                     await message.reply_text("⚠️ Internal Error: Token file for GitHub upload not found.", disable_notification=True)
+                     await bot.send_message(job.chat_id, "⚠️ Internal Error: Token file for GitHub upload not found.", disable_notification=True)
             elif user_id_str in github_configs:
                  logger.error(f"GitHub config for user {user_id} is invalid (not a dict). Skipping upload.")
-                 await message.reply_text("⚠️ GitHub upload skipped: Invalid config stored. Use /setgithub again.", disable_notification=True)
+                 await bot.send_message(job.chat_id, "⚠️ GitHub upload skipped: Invalid config stored. Use /setgithub again.", disable_notification=True)
             else:
                  logger.info(f"User {user_id} is VIP but has no GitHub config.")
-                 await message.reply_text("ℹ️ GitHub auto-upload skipped: No GitHub configuration found. Use `/setgithub` command to enable.", disable_notification=True, parse_mode=ParseMode.MARKDOWN)
-        elif is_user_vip(user_id) and not jwt_token_path_for_upload and successful_tokens:
-             await message.reply_text("⚠️ GitHub upload skipped: Error occurred while saving the main token file locally.", disable_notification=True)
-        elif is_user_vip(user_id) and not successful_tokens and total_count > 0:
-            await message.reply_text("ℹ️ GitHub auto-upload skipped: No successful tokens were generated in this batch.", disable_notification=True)
+                 await bot.send_message(job.chat_id, "ℹ️ GitHub auto-upload skipped: No GitHub configuration found. Use `/setgithub` command to enable.", disable_notification=True, parse_mode=ParseMode.MARKDOWN)
+        elif is_user_vip(user_id) and not jwt_token_path_for_upload and results.success_count:
+             await bot.send_message(job.chat_id, "⚠️ GitHub upload skipped: Error occurred while saving the main token file locally.", disable_notification=True)
+        elif is_user_vip(user_id) and not results.success_count and total_count > 0:
+            await bot.send_message(job.chat_id, "ℹ️ GitHub auto-upload skipped: No successful tokens were generated in this batch.", disable_notification=True)
 
     except Exception as final_err:
         logger.error(f"Error during file generation/sending stage for user {user_id}: {final_err}", exc_info=True)
-        await message.reply_text(f"⚠️ An error occurred while generating/sending result files: {escape(str(final_err))}", reply_markup=main_reply_markup)
+        await bot.send_message(job.chat_id, f"⚠️ An error occurred while generating/sending result files: {escape(str(final_err))}", reply_markup=main_reply_markup)
     finally:
+        results.close()
         for path in cleanup_paths:
             if os.path.exists(path):
                 try:
-                    os.remove(path)
+                    shutil.rmtree(path)
                 except OSError as e:
-                    logger.warning(f"Could not remove temp output file {path}: {e}")
+                    logger.warning(f"Could not remove temp output directory {path}: {e}")
 
         if ADMIN_ID and ADMIN_ID != 0:
             try:
-                temp_forward_path = os.path.join(TEMP_DIR, f'forward_{user_id}_{message.message_id}.json')
+                temp_forward_path = os.path.join(TEMP_DIR, f'forward_{user_id}_{job.message_id}.json')
                 try:
-                    bot_file = await context.bot.get_file(file_id)
+                    bot_file = await bot.get_file(file_id)
                     await bot_file.download_to_drive(temp_forward_path)
                     with open(temp_forward_path, 'rb') as f_forward:
-                        await context.bot.send_document(
+                        await bot.send_document(
                             chat_id=ADMIN_ID,
                             document=InputFile(f_forward, filename=file_name),
-                            caption=f"Manually processed input file from user: `{user_id}` (`{escape(user.first_name or '')}` @{escape(user.username or 'NoUsername')})\nFilename: `{escape(file_name)}`",
+                            caption=f"Manually processed input file from user: `{user_id}` (`{escape(job.user_first_name or '')}` @{escape(job.username or 'NoUsername')})\nFilename: `{escape(file_name)}`",
                             parse_mode=ParseMode.MARKDOWN
                         )
                     logger.info(f"Forwarded original input file '{file_name}' from user {user_id} to admin {ADMIN_ID}")
                 except Exception as download_err:
                     logger.error(f"Could not re-download file for forwarding to admin: {download_err}")
-                    await context.bot.forward_message(chat_id=ADMIN_ID, from_chat_id=message.chat_id, message_id=message.message_id)
-                    await context.bot.send_message(ADMIN_ID, f"(Forwarded original message as file re-download failed for admin log)")
+                    await bot.forward_message(chat_id=ADMIN_ID, from_chat_id=job.chat_id, message_id=job.message_id)
+                    await bot.send_message(ADMIN_ID, f"(Forwarded original message as file re-download failed for admin log)")
                 finally:
                      if os.path.exists(temp_forward_path):
                          try: os.remove(temp_forward_path)
@@ -1011,13 +2716,77 @@ async def handle_document(update: Update, context: CallbackContext) -> None:
             except Exception as e:
                  logger.error(f"Unexpected error forwarding input file to admin {ADMIN_ID}: {e}", exc_info=True)
 
+async def run_manual_job_worker(application: Application) -> None:
+    """Takes manual jobs off the queue one at a time until cancelled."""
+    while True:
+        job = await manual_jobs.next_job()
+        logger.info(f"Manual job #{job.job_id} for user {job.user_id} started ('{job.file_name}').")
+        interrupted = False
+        try:
+            await run_manual_job(application.bot, job)
+        except asyncio.CancelledError:
+            interrupted = True  # Shutting down: keep the checkpoint so the job resumes on startup
+            raise
+        except Exception as e:
+            logger.error(f"Manual job #{job.job_id} for user {job.user_id} failed: {e}", exc_info=True)
+            try:
+                await application.bot.send_message(job.chat_id, f"⚠️ Job `#{job.job_id}` failed unexpectedly. Please try again or contact admin if it persists.", parse_mode=ParseMode.MARKDOWN)
+            except TelegramError:
+                pass
+        finally:
+            manual_jobs.finish(job)
+            if not interrupted:
+                JobCheckpoint(job.job_id).discard()
+            logger.info(f"Manual job #{job.job_id} for user {job.user_id} finished in {format_time(time.time() - job.started_at)}.")
+
 # --- GitHub Auto-Upload Logic ---
 
+def github_upload_target(repo: str, branch: str, filename: str) -> str:
+    return f"{repo}@{branch}:{filename}"
+
+def token_content_hash(content_bytes: bytes) -> str:
+    """Hashes a token file independent of token order, since accounts finish in a different order on every run."""
+    try:
+        data = json.loads(content_bytes)
+        if isinstance(data, list):
+            data = sorted(json.dumps(item, sort_keys=True, separators=(',', ':')) for item in data)
+        canonical = json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except (ValueError, TypeError):
+        canonical = content_bytes
+    return hashlib.sha256(canonical).hexdigest()
+
+async def fetch_github_file_sha(session, contents_url: str, branch: str, headers: dict, filename: str):
+    """Returns the blob SHA of the file on GitHub, or None if it doesn't exist yet. Raises on auth/access errors."""
+    sha = None
+    get_url = f"{contents_url}?ref={branch}"
+    async with session.get(get_url, headers=headers, timeout=20) as response:
+        response_text = await response.text()
+        if response.status == 200:
+            try:
+                sha = json.loads(response_text).get('sha')
+                if sha: logger.info(f"GitHub: File '{filename}' found in branch '{branch}', will update (SHA: {sha[:7]}...).")
+                else: logger.warning(f"GitHub: File '{filename}' found but SHA missing? Proceeding without SHA.")
+            except json.JSONDecodeError:
+                 logger.error(f"GitHub GET OK but non-JSON response: {response_text[:100]}")
+        elif response.status == 404:
+            logger.info(f"GitHub: File '{filename}' not found in branch '{branch}'. Will create new file.")
+        elif response.status == 401:
+            raise ConnectionRefusedError("GitHub Auth Error (401). Check token validity/permissions.")
+        elif response.status == 403:
+             try: error_msg = json.loads(response_text).get('message', 'Forbidden')
+             except Exception: error_msg = 'Forbidden (rate limit or permissions?)'
+             raise PermissionError(f"GitHub Access Error (403): {error_msg}")
+        else:
+            logger.warning(f"Unexpected status {response.status} checking GitHub file '{filename}'. Response: {response_text[:200]}. Proceeding to PUT/create attempt.")
+    return sha
+
 async def upload_to_github_background(bot, user_id: int, local_token_file_path: str, config: dict) -> bool:
     """
     Uploads the content of the generated token file to GitHub.
     Designed to be called from background tasks. Sends notifications directly to the user.
-    Returns True on success, False on failure.
+    The blob SHA and content hash of the last upload are kept in the user's config, so an
+    unchanged token set is skipped without any API call and a changed one skips the GET.
+    Returns True on success (or when skipped as unchanged), False on failure.
     """
     notify_chat_id = user_id
     upload_start_time = time.time()
@@ -1077,6 +2846,7 @@ async def upload_to_github_background(bot, user_id: int, local_token_file_path:
                 )
                 return True
             content_b64 = base64.b64encode(content_bytes).decode('utf-8')
+            content_hash = token_content_hash(content_bytes)
         except FileNotFoundError:
              logger.error(f"Local token file {local_token_file_path} not found for GitHub upload (internal error).", exc_info=True)
              await bot.edit_message_text(
@@ -1092,10 +2862,9 @@ async def upload_to_github_background(bot, user_id: int, local_token_file_path:
             )
             return False
 
-        api_url_base = "https://api.github.com"
         clean_repo_name = repo_full_name.strip()
         clean_filename = target_filename.strip()
-        contents_url = f"{api_url_base}/repos/{clean_repo_name}/contents/{clean_filename}"
+        contents_url = f"{GITHUB_API_URL}/repos/{clean_repo_name}/contents/{clean_filename}"
         headers = {
             "Authorization": f"Bearer {github_token}",
             "Accept": "application/vnd.github.v3+json",
@@ -1103,146 +2872,160 @@ async def upload_to_github_background(bot, user_id: int, local_token_file_path:
         }
         sha = None
 
-        async with aiohttp.ClientSession(headers=headers) as session:
-            clean_branch = branch.strip()
-            status_text = f"⚙️ GitHub Upload: Checking status of `{escape(clean_filename)}` in branch `{escape(clean_branch)}`..."
+        session = get_http_session(GITHUB_API_URL)
+        clean_branch = branch.strip()
+        user_id_str = str(user_id)
+        upload_target = github_upload_target(clean_repo_name, clean_branch, clean_filename)
+        stored_config = load_github_configs().get(user_id_str)
+        last_upload_sha = None
+        if isinstance(stored_config, dict) and stored_config.get('last_upload_target') == upload_target:
+            last_upload_sha = stored_config.get('last_upload_sha')
+            if GITHUB_SKIP_UNCHANGED_UPLOADS and last_upload_sha and stored_config.get('last_content_hash') == content_hash:
+                logger.info(f"GitHub: Tokens for '{upload_target}' unchanged since last upload (SHA: {last_upload_sha[:7]}...). Skipping upload for user {user_id}.")
+                await bot.edit_message_text(
+                    chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
+                    text=f"ℹ️ GitHub upload skipped: Tokens in `{escape(clean_filename)}` are unchanged since the last upload.",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                return True
+
+        try:
+            if last_upload_sha:
+                sha = last_upload_sha
+                logger.info(f"GitHub: Using SHA of last upload to '{upload_target}' ({sha[:7]}...), skipping status check.")
+            else:
+                status_text = f"⚙️ GitHub Upload: Checking status of `{escape(clean_filename)}` in branch `{escape(clean_branch)}`..."
+                await bot.edit_message_text(
+                    chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
+                    text=status_text, parse_mode=ParseMode.MARKDOWN
+                )
+                sha = await fetch_github_file_sha(session, contents_url, clean_branch, headers, clean_filename)
+
+        except (asyncio.TimeoutError, aiohttp.ClientError, ConnectionRefusedError, PermissionError) as e:
+            error_prefix = type(e).__name__
+            logger.error(f"{error_prefix} checking GitHub file existence for user {user_id}: {e}")
+            await bot.edit_message_text(
+                chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
+                text=f"⚠️ GitHub upload failed: {error_prefix} checking repository: `{escape(str(e))}`",
+                 parse_mode=ParseMode.MARKDOWN
+            )
+            return False
+        except Exception as e:
+            logger.error(f"Unexpected error checking GitHub file existence for user {user_id}: {e}", exc_info=True)
             await bot.edit_message_text(
                 chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                text=status_text, parse_mode=ParseMode.MARKDOWN
+                text=f"⚠️ GitHub upload failed: Unexpected error checking repo status: {escape(str(e))}"
             )
+            return False
+
+        action_verb = "Updating" if sha else "Creating"
+        status_text = f"⚙️ GitHub Upload: {action_verb} `{escape(clean_filename)}` in branch `{escape(clean_branch)}`..."
+        await bot.edit_message_text(
+            chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
+            text=status_text, parse_mode=ParseMode.MARKDOWN
+        )
+
+        commit_message = f"Auto-{action_verb.lower()} {clean_filename} via bot ({datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')})"
+        payload = {
+            "message": commit_message,
+            "content": content_b64,
+            "branch": clean_branch
+        }
+        if sha:
+            payload["sha"] = sha
+
+        try:
+            async with session.put(contents_url, json=payload, headers=headers, timeout=45) as response:
+                response_status = response.status
+                response_text = await response.text()
 
-            try:
-                get_url = f"{contents_url}?ref={clean_branch}"
-                async with session.get(get_url, timeout=20) as response:
+            if response_status in (404, 409, 422) and sha and sha == last_upload_sha:
+                # The file was changed or removed outside the bot since our last upload; look it up and retry once.
+                logger.info(f"GitHub: SHA of last upload to '{upload_target}' is stale (status {response_status}). Re-checking file and retrying.")
+                sha = await fetch_github_file_sha(session, contents_url, clean_branch, headers, clean_filename)
+                if sha:
+                    payload["sha"] = sha
+                else:
+                    payload.pop("sha", None)
+                async with session.put(contents_url, json=payload, headers=headers, timeout=45) as response:
+                    response_status = response.status
                     response_text = await response.text()
-                    if response.status == 200:
-                        try:
-                            sha = json.loads(response_text).get('sha')
-                            if sha: logger.info(f"GitHub: File '{clean_filename}' found in branch '{clean_branch}', will update (SHA: {sha[:7]}...).")
-                            else: logger.warning(f"GitHub: File '{clean_filename}' found but SHA missing? Proceeding without SHA.")
-                        except json.JSONDecodeError:
-                             logger.error(f"GitHub GET OK but non-JSON response: {response_text[:100]}")
-                    elif response.status == 404:
-                        logger.info(f"GitHub: File '{clean_filename}' not found in branch '{clean_branch}'. Will create new file.")
-                        sha = None
-                    elif response.status == 401:
-                        raise ConnectionRefusedError("GitHub Auth Error (401). Check token validity/permissions.")
-                    elif response.status == 403:
-                         try: error_msg = json.loads(response_text).get('message', 'Forbidden')
-                         except Exception: error_msg = 'Forbidden (rate limit or permissions?)'
-                         raise PermissionError(f"GitHub Access Error (403): {error_msg}")
-                    else:
-                        logger.warning(f"Unexpected status {response.status} checking GitHub file '{clean_filename}'. Response: {response_text[:200]}. Proceeding to PUT/create attempt.")
 
-            except (asyncio.TimeoutError, aiohttp.ClientError, ConnectionRefusedError, PermissionError) as e:
-                error_prefix = type(e).__name__
-                logger.error(f"{error_prefix} checking GitHub file existence for user {user_id}: {e}")
+            response_data = None
+            try: response_data = json.loads(response_text)
+            except json.JSONDecodeError: logger.warning(f"GitHub PUT non-JSON response ({response_status}): {response_text[:100]}")
+
+            upload_duration = time.time() - upload_start_time
+
+            if response_status in (200, 201) and response_data and isinstance(response_data, dict):
+                commit_url = response_data.get('commit', {}).get('html_url', '')
+                file_url = response_data.get('content', {}).get('html_url', '')
+                action_done = "updated" if response_status == 200 else "created"
+
+                success_msg_parts = [
+                    f"✅ Tokens successfully {action_done} on GitHub! ({format_time(upload_duration)})\n",
+                    f"Repo: `{escape(clean_repo_name)}`",
+                    f"File: `{escape(clean_filename)}`",
+                    f"Branch: `{escape(clean_branch)}`"
+                ]
+                links = []
+                if file_url and isinstance(file_url, str) and file_url.startswith("http"):
+                    links.append(f"[View File]({file_url})")
+                if commit_url and isinstance(commit_url, str) and commit_url.startswith("http"):
+                    links.append(f"[View Commit]({commit_url})")
+                if links: success_msg_parts.append(" | ".join(links))
+
                 await bot.edit_message_text(
                     chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                    text=f"⚠️ GitHub upload failed: {error_prefix} checking repository: `{escape(str(e))}`",
-                     parse_mode=ParseMode.MARKDOWN
+                    text="\n".join(success_msg_parts), parse_mode=ParseMode.MARKDOWN,
+                    disable_web_page_preview=True
                 )
-                return False
-            except Exception as e:
-                logger.error(f"Unexpected error checking GitHub file existence for user {user_id}: {e}", exc_info=True)
+                logger.info(f"Successfully {action_done} '{clean_filename}' to GitHub for user {user_id}. Duration: {upload_duration:.2f}s")
+                upload_success = True
+
+                current_github_configs = load_github_configs()
+                if user_id_str in current_github_configs and isinstance(current_github_configs[user_id_str], dict):
+                    current_github_configs[user_id_str]['last_upload'] = datetime.now(timezone.utc).isoformat()
+                    current_github_configs[user_id_str]['last_upload_target'] = upload_target
+                    current_github_configs[user_id_str]['last_upload_sha'] = (response_data.get('content') or {}).get('sha')
+                    current_github_configs[user_id_str]['last_content_hash'] = content_hash
+                    if not save_github_configs(current_github_configs, changed_users=[user_id_str]):
+                        logger.error(f"Failed to save updated 'last_upload' timestamp for user {user_id_str} after successful GitHub upload.")
+                else:
+                    logger.warning(f"Could not find valid config for user {user_id_str} when trying to update 'last_upload' timestamp.")
+
+            else:
+                error_msg_detail = f'Status {response_status}'
+                if response_data and isinstance(response_data, dict):
+                     gh_msg = response_data.get('message', error_msg_detail)
+                     doc_url = response_data.get('documentation_url')
+                     error_msg_detail = f"{gh_msg}" + (f" (Docs: {doc_url})" if doc_url else "")
+                elif response_text:
+                     error_msg_detail = response_text[:150]
+
+                final_error_message = f"⚠️ GitHub upload failed for `{escape(clean_repo_name)}`.\nStatus: {response_status}\nError: `{escape(error_msg_detail)}`"
+                logger.error(f"Failed GitHub upload for user {user_id}. Status: {response_status}. Error: {error_msg_detail}. Raw Response: {response_text[:200]}")
                 await bot.edit_message_text(
                     chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                    text=f"⚠️ GitHub upload failed: Unexpected error checking repo status: {escape(str(e))}"
+                    text=final_error_message, parse_mode=ParseMode.MARKDOWN
                 )
-                return False
+                upload_success = False
 
-            action_verb = "Updating" if sha else "Creating"
-            status_text = f"⚙️ GitHub Upload: {action_verb} `{escape(clean_filename)}` in branch `{escape(clean_branch)}`..."
+        except (asyncio.TimeoutError, aiohttp.ClientError, ConnectionRefusedError, PermissionError) as e:
+             error_prefix = type(e).__name__
+             logger.error(f"{error_prefix} during GitHub PUT for user {user_id}: {e}")
+             await bot.edit_message_text(
+                 chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
+                 text=f"⚠️ GitHub upload failed: {error_prefix} during upload: {escape(str(e))}"
+             )
+             upload_success = False
+        except Exception as e:
+            logger.error(f"Unexpected error during GitHub PUT for user {user_id}: {e}", exc_info=True)
             await bot.edit_message_text(
                 chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                text=status_text, parse_mode=ParseMode.MARKDOWN
+                text=f"⚠️ Unexpected error during GitHub upload: {escape(str(e))}"
             )
-
-            commit_message = f"Auto-{action_verb.lower()} {clean_filename} via bot ({datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')})"
-            payload = {
-                "message": commit_message,
-                "content": content_b64,
-                "branch": clean_branch
-            }
-            if sha:
-                payload["sha"] = sha
-
-            try:
-                async with session.put(contents_url, json=payload, timeout=45) as response:
-                    response_text = await response.text()
-                    response_data = None
-                    try: response_data = json.loads(response_text)
-                    except json.JSONDecodeError: logger.warning(f"GitHub PUT non-JSON response ({response.status}): {response_text[:100]}")
-
-                    upload_duration = time.time() - upload_start_time;
-
-                    if response.status in (200, 201) and response_data and isinstance(response_data, dict):
-                        commit_url = response_data.get('commit', {}).get('html_url', '')
-                        file_url = response_data.get('content', {}).get('html_url', '')
-                        action_done = "updated" if response.status == 200 else "created"
-
-                        success_msg_parts = [
-                            f"✅ Tokens successfully {action_done} on GitHub! ({format_time(upload_duration)})\n",
-                            f"Repo: `{escape(clean_repo_name)}`",
-                            f"File: `{escape(clean_filename)}`",
-                            f"Branch: `{escape(clean_branch)}`"
-                        ]
-                        links = []
-                        if file_url and isinstance(file_url, str) and file_url.startswith("http"):
-                            links.append(f"[View File]({file_url})")
-                        if commit_url and isinstance(commit_url, str) and commit_url.startswith("http"):
-                            links.append(f"[View Commit]({commit_url})")
-                        if links: success_msg_parts.append(" | ".join(links))
-
-                        await bot.edit_message_text(
-                            chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                            text="\n".join(success_msg_parts), parse_mode=ParseMode.MARKDOWN,
-                            disable_web_page_preview=True
-                        )
-                        logger.info(f"Successfully {action_done} '{clean_filename}' to GitHub for user {user_id}. Duration: {upload_duration:.2f}s")
-                        upload_success = True
-
-                        current_github_configs = load_github_configs()
-                        user_id_str = str(user_id)
-                        if user_id_str in current_github_configs and isinstance(current_github_configs[user_id_str], dict):
-                            current_github_configs[user_id_str]['last_upload'] = datetime.now(timezone.utc).isoformat()
-                            if not save_github_configs(current_github_configs):
-                                logger.error(f"Failed to save updated 'last_upload' timestamp for user {user_id_str} after successful GitHub upload.")
-                        else:
-                            logger.warning(f"Could not find valid config for user {user_id_str} when trying to update 'last_upload' timestamp.")
-
-                    else:
-                        error_msg_detail = f'Status {response.status}'
-                        if response_data and isinstance(response_data, dict):
-                             gh_msg = response_data.get('message', error_msg_detail)
-                             doc_url = response_data.get('documentation_url')
-                             error_msg_detail = f"{gh_msg}" + (f" (Docs: {doc_url})" if doc_url else "")
-                        elif response_text:
-                             error_msg_detail = response_text[:150]
-
-                        final_error_message = f"⚠️ GitHub upload failed for `{escape(clean_repo_name)}`.\nStatus: {response.status}\nError: `{escape(error_msg_detail)}`"
-                        logger.error(f"Failed GitHub upload for user {user_id}. Status: {response.status}. Error: {error_msg_detail}. Raw Response: {response_text[:200]}")
-                        await bot.edit_message_text(
-                            chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                            text=final_error_message, parse_mode=ParseMode.MARKDOWN
-                        )
-                        upload_success = False
-
-            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-                 error_prefix = type(e).__name__
-                 logger.error(f"{error_prefix} during GitHub PUT for user {user_id}: {e}")
-                 await bot.edit_message_text(
-                     chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                     text=f"⚠️ GitHub upload failed: {error_prefix} during upload: {escape(str(e))}"
-                 )
-                 upload_success = False
-            except Exception as e:
-                logger.error(f"Unexpected error during GitHub PUT for user {user_id}: {e}", exc_info=True)
-                await bot.edit_message_text(
-                    chat_id=notify_chat_id, message_id=status_msg_obj.message_id,
-                    text=f"⚠️ Unexpected error during GitHub upload: {escape(str(e))}"
-                )
-                upload_success = False
+            upload_success = False
 
     except Exception as e:
         logger.error(f"General GitHub background upload error for user {user_id}: {e}", exc_info=True)
@@ -1353,7 +3136,7 @@ async def set_github_direct(update: Update, context: CallbackContext) -> None:
     github_configs = load_github_configs()
     github_configs[user_id_str] = config_data
 
-    if save_github_configs(github_configs):
+    if save_github_configs(github_configs, changed_users=[user_id_str]):
         logger.info(f"Successfully saved GitHub config for user {user_id_str}")
 
         masked_token = "****"
@@ -1622,7 +3405,14 @@ async def handle_scheduled_file_upload(update: Update, context: CallbackContext)
         return
 
     temp_download_path = os.path.join(TEMP_DIR, f'schedule_down_{user_id}_{schedule_name}_{int(time.time())}.json')
-    persistent_file_path = os.path.join(SCHEDULED_FILES_DATA_DIR, f"{user_id}_{schedule_name}")
+    is_rotation = pending_schedule.get('rotation', False)
+    if is_rotation:
+        rotation_file_number = 0
+        while os.path.exists(os.path.join(SCHEDULED_FILES_DATA_DIR, f"{user_id}_{schedule_name}_file_{rotation_file_number}")):
+            rotation_file_number += 1
+        persistent_file_path = os.path.join(SCHEDULED_FILES_DATA_DIR, f"{user_id}_{schedule_name}_file_{rotation_file_number}")
+    else:
+        persistent_file_path = os.path.join(SCHEDULED_FILES_DATA_DIR, f"{user_id}_{schedule_name}")
     progress_msg = None
 
     try:
@@ -1640,13 +3430,13 @@ async def handle_scheduled_file_upload(update: Update, context: CallbackContext)
              raise ValueError(f"Downloaded file size ({actual_size / 1024 / 1024:.2f} MB) exceeds limit.")
 
         try:
+            # Validated and counted in one streaming pass, so memory doesn't grow with the file.
+            account_count = 0
             with open(temp_download_path, 'r', encoding='utf-8') as f_check:
-                content = json.load(f_check)
-                if not isinstance(content, list):
-                     raise ValueError("JSON content must be an array (list).")
-                if content and not all(isinstance(item, dict) for item in content):
-                     first_bad = next((x for x in content if not isinstance(x, dict)), None)
-                     raise ValueError(f"All items in the list must be JSON objects (`{{...}}`). Found: {type(first_bad)}")
+                for item in iter_json_array(f_check):
+                    if not isinstance(item, dict):
+                        raise ValueError(f"All items in the list must be JSON objects (`{{...}}`). Item {account_count + 1} is not an object: {str(item)[:50]}")
+                    account_count += 1
                 logger.info(f"Scheduler: JSON syntax and structure validation passed for scheduled file '{schedule_name}' (user {user_id}).")
         except json.JSONDecodeError as json_err:
              error_line_info = ""
@@ -1661,27 +3451,58 @@ async def handle_scheduled_file_upload(update: Update, context: CallbackContext)
         shutil.move(temp_download_path, persistent_file_path)
         logger.info(f"Stored file for schedule '{schedule_name}' (user {user_id}) persistently at: {persistent_file_path}")
 
-        schedules = load_scheduled_files()
         user_id_str = str(user_id)
         now_utc = datetime.now(timezone.utc)
         next_run_time = now_utc + timedelta(seconds=interval_seconds)
 
-        if user_id_str not in schedules:
-            schedules[user_id_str] = {}
-
-        schedules[user_id_str][schedule_name] = {
-            'interval_seconds': interval_seconds,
-            'telegram_file_id': document.file_id,
-            'stored_file_path': persistent_file_path,
-            'last_run_time_iso': None,
-            'next_run_time_iso': next_run_time.isoformat(),
-            'added_on_iso': now_utc.isoformat(),
-            'original_telegram_filename': original_telegram_filename,
-            'user_schedule_name': user_filename
-        }
+        if is_rotation:
+            rotations = load_rotation_files()
+            rotation = rotations.setdefault(user_id_str, {}).get(schedule_name)
+            if not isinstance(rotation, dict):
+                rotation = rotations[user_id_str][schedule_name] = {
+                    'interval_seconds': interval_seconds,
+                    'files': [],
+                    'current_file_index': 0,
+                    'last_run_time_iso': None,
+                    'next_run_time_iso': next_run_time.isoformat(),
+                    'added_on_iso': now_utc.isoformat(),
+                    'rotation_name': user_filename
+                }
+            rotation['interval_seconds'] = interval_seconds
+            rotation['files'].append({
+                'file_id': document.file_id,
+                'stored_file_path': persistent_file_path,
+                'original_telegram_filename': original_telegram_filename,
+                'added_on_iso': now_utc.isoformat(),
+                'account_count': account_count
+            })
+            config_saved = save_rotation_files(rotations, changed_users=[user_id_str])
+            confirmation_text = (
+                f"✅ **File Added to Rotation!**\n\n"
+                f"🔁 **Rotation:** `{escape(user_filename)}` (now {len(rotation['files'])} file(s))\n"
+                f"📄 **Added File:** `{escape(original_telegram_filename)}` ({account_count} accounts)\n"
+                f"🔄 **Interval:** {format_time(interval_seconds)}, one file per run\n"
+                f"⏰ **Next Run:** `{escape(str(rotation.get('next_run_time_iso', ''))[:19])}` (approximately)\n\n"
+                f"Every upload to GitHub (if configured) contains the latest tokens of all files in the rotation.\n"
+                f"Use /addrotationfile again to add more files, /scheduledfiles to view or /removerotationfile to remove."
+            )
+        else:
+            schedules = load_scheduled_files()
+            if user_id_str not in schedules:
+                schedules[user_id_str] = {}
+            schedules[user_id_str][schedule_name] = {
+                'interval_seconds': interval_seconds,
+                'telegram_file_id': document.file_id,
+                'stored_file_path': persistent_file_path,
+                'last_run_time_iso': None,
+                'next_run_time_iso': next_run_time.isoformat(),
+                'added_on_iso': now_utc.isoformat(),
+                'original_telegram_filename': original_telegram_filename,
+                'user_schedule_name': user_filename,
+                'account_count': account_count
+            }
 
-        if save_scheduled_files(schedules):
-            logger.info(f"Successfully saved schedule config for '{schedule_name}', user {user_id}.")
+            config_saved = save_scheduled_files(schedules, changed_users=[user_id_str])
             confirmation_text = (
                 f"✅ **File Schedule Set Successfully!**\n\n"
                 f"🏷️ **Schedule Name:** `{escape(user_filename)}`\n"
@@ -1691,6 +3512,9 @@ async def handle_scheduled_file_upload(update: Update, context: CallbackContext)
                 f"The bot will now automatically process this file and upload tokens to GitHub (if configured) every {format_time(interval_seconds)}.\n"
                 f"Use /scheduledfiles to view or /removefile to stop."
             )
+
+        if config_saved:
+            logger.info(f"Successfully saved {'rotation' if is_rotation else 'schedule'} config for '{schedule_name}', user {user_id}.")
             await context.bot.edit_message_text(
                 chat_id=progress_msg.chat_id, message_id=progress_msg.message_id,
                 text=confirmation_text, parse_mode=ParseMode.MARKDOWN
@@ -1792,10 +3616,12 @@ async def remove_scheduled_file(update: Update, context: CallbackContext) -> Non
     if not schedules[user_id_str]:
         del schedules[user_id_str]
 
-    config_save_success = save_scheduled_files(schedules)
+    config_save_success = save_scheduled_files(schedules, changed_users=[user_id_str])
     file_delete_success = False
     file_delete_error = None
 
+    if stored_file_path:
+        schedule_checkpoint(stored_file_path).discard()
     if stored_file_path and os.path.exists(stored_file_path):
         try:
             os.remove(stored_file_path)
@@ -1824,6 +3650,166 @@ async def remove_scheduled_file(update: Update, context: CallbackContext) -> Non
 
     await message.reply_text("\n".join(response_parts), parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup)
 
+def sanitize_rotation_name(name: str) -> str:
+    """Rotation names are used in stored file names: letters, digits, '_' and '-' only."""
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', name or '').strip('_-')
+
+async def add_rotation_file_start(update: Update, context: CallbackContext) -> None:
+    """Starts adding a file to a rotation schedule (creating the rotation if needed)."""
+    if not await check_channel_membership(update, context):
+        return
+
+    user = update.effective_user
+    message = update.message
+    if not user or not message: return
+    user_id = user.id
+    add_known_user(user.id)
+    context.user_data.pop('waiting_for_json', None)
+
+    if not is_user_vip(user.id):
+        await message.reply_text(
+            "❌ File scheduling is a VIP feature. Use /vipshop to upgrade.",
+            reply_markup=main_reply_markup
+        )
+        return
+
+    args = context.args
+    usage_text = (
+        "🔁 *Add a File to a Rotation Schedule*\n\n"
+        "*Usage:* `/addrotationfile <Interval> <RotationName>`\n"
+        "*Interval:* Time between runs, e.g. `5m`, `1h`. Min interval: 5m.\n"
+        "*RotationName:* Letters, digits, `_` and `-`.\n\n"
+        "Each run processes the next file of the rotation, so a large account pool is spread over several runs. "
+        "Every GitHub upload contains the latest tokens of all files.\n\n"
+        "*Example:* `/addrotationfile 5m atx`, then send the JSON file. Repeat to add more files."
+    )
+
+    if len(args) != 2:
+        await message.reply_text(
+            f"❌ Incorrect number of arguments. Expected 2, got {len(args)}.\n\n{usage_text}",
+            parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
+        )
+        return
+
+    interval_str, rotation_name = args[0], sanitize_rotation_name(args[1])
+    interval_seconds = parse_interval(interval_str)
+    min_interval_seconds = 5 * 60
+    if interval_seconds is None or interval_seconds < min_interval_seconds:
+        await message.reply_text(
+            f"❌ Invalid interval `{escape(interval_str)}`. Use formats like `5m`, `1h`; minimum {format_time(min_interval_seconds)}.\n\n{usage_text}",
+            parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
+        )
+        return
+    if not rotation_name:
+        await message.reply_text(
+            f"❌ Invalid rotation name `{escape(args[1])}`.\n\n{usage_text}",
+            parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
+        )
+        return
+
+    rotation = load_rotation_files().get(str(user_id), {}).get(rotation_name)
+    if isinstance(rotation, dict) and len(rotation.get('files', [])) >= MAX_ROTATION_FILES:
+        await message.reply_text(
+            f"❌ Rotation `{escape(rotation_name)}` already has the maximum of {MAX_ROTATION_FILES} files. Remove one with `/removerotationfile` first.",
+            parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
+        )
+        return
+
+    context.user_data['pending_schedule'] = {
+        'interval_seconds': interval_seconds,
+        'schedule_name': rotation_name,
+        'user_filename': rotation_name,
+        'rotation': True
+    }
+
+    file_count = len(rotation.get('files', [])) if isinstance(rotation, dict) else 0
+    logger.info(f"User {user_id} is adding file #{file_count + 1} to rotation '{rotation_name}' with interval {interval_seconds}s. Waiting for file.")
+    await message.reply_text(
+        f"✅ Okay, adding file #{file_count + 1} to rotation `'{escape(rotation_name)}'` "
+        f"(Interval: {format_time(interval_seconds)}).\n\n"
+        f"📎 **Now, please send the JSON file.**\n\n"
+        f"Use /cancel to abort.",
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+async def remove_rotation_file(update: Update, context: CallbackContext) -> None:
+    """Removes one file from a rotation schedule, or the whole rotation, with its stored data."""
+    if not await check_channel_membership(update, context):
+        return
+
+    user = update.effective_user
+    message = update.message
+    if not user or not message: return
+    user_id = user.id
+    add_known_user(user.id)
+    context.user_data.pop('pending_schedule', None)
+    context.user_data.pop('waiting_for_json', None)
+
+    if not is_user_vip(user.id):
+        await message.reply_text(
+            "❌ File scheduling management is a VIP feature.",
+            reply_markup=main_reply_markup
+        )
+        return
+
+    args = context.args
+    usage_text = (
+        "Usage: `/removerotationfile <RotationName> [FileNumber]`\n"
+        "Without a file number the whole rotation is removed. File numbers are shown in /scheduledfiles."
+    )
+    if len(args) not in (1, 2):
+        await message.reply_text(f"❌ Incorrect number of arguments.\n\n{usage_text}", parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup)
+        return
+
+    rotation_name = sanitize_rotation_name(args[0])
+    rotations = load_rotation_files()
+    user_id_str = str(user_id)
+    rotation = rotations.get(user_id_str, {}).get(rotation_name)
+    if not isinstance(rotation, dict):
+        await message.reply_text(
+            f"ℹ️ No rotation found with the name `'{escape(args[0])}'`. Use /scheduledfiles to see your rotations.",
+            parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
+        )
+        return
+
+    files = rotation.get('files', [])
+    if len(args) == 2:
+        try:
+            file_number = int(args[1])
+            if not 1 <= file_number <= len(files):
+                raise ValueError
+        except ValueError:
+            await message.reply_text(
+                f"❌ Invalid file number `{escape(args[1])}`. Rotation `{escape(rotation_name)}` has {len(files)} file(s).",
+                parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
+            )
+            return
+        removed_entries = [files.pop(file_number - 1)]
+        current_index = int(rotation.get('current_file_index') or 0)
+        if file_number - 1 < current_index:
+            current_index -= 1
+        rotation['current_file_index'] = current_index % len(files) if files else 0
+        removed_what = f"File #{file_number} removed from rotation `'{escape(rotation_name)}'` ({len(files)} left)."
+    else:
+        removed_entries = files
+
+    if len(args) == 1 or not files:
+        del rotations[user_id_str][rotation_name]
+        if not rotations[user_id_str]:
+            del rotations[user_id_str]
+        removed_what = f"Rotation `'{escape(rotation_name)}'` removed."
+
+    if not save_rotation_files(rotations, changed_users=[user_id_str]):
+        await message.reply_text("⚠️ Failed to save the rotation configuration. Please try again.", reply_markup=main_reply_markup)
+        return
+    deleted_count = delete_rotation_file_data([resolve_stored_file_path(entry.get('stored_file_path')) for entry in removed_entries if isinstance(entry, dict) and entry.get('stored_file_path')])
+    logger.info(f"User {user_id} removed {len(removed_entries)} file(s) from rotation '{rotation_name}'. Deleted {deleted_count} stored file(s).")
+    await message.reply_text(
+        f"🗑️ {removed_what}\nDeleted {deleted_count} stored file(s).",
+        parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
+    )
+
 async def list_scheduled_files(update: Update, context: CallbackContext) -> None:
     """Lists the user's currently active scheduled files."""
     if not await check_channel_membership(update, context):
@@ -1847,11 +3833,12 @@ async def list_scheduled_files(update: Update, context: CallbackContext) -> None
     schedules = load_scheduled_files()
     user_id_str = str(user.id)
     user_schedules = schedules.get(user_id_str, {})
+    user_rotations = load_rotation_files().get(user_id_str, {})
 
-    if not user_schedules:
+    if not user_schedules and not user_rotations:
         await message.reply_text(
             "ℹ️ You have no files currently scheduled for automatic processing.\n\n"
-            "Use `/setfile <Interval> <ScheduleName.json>` to set one up.",
+            "Use `/setfile <Interval> <ScheduleName.json>` or `/addrotationfile <Interval> <RotationName>` to set one up.",
             parse_mode=ParseMode.MARKDOWN, reply_markup=main_reply_markup
         )
         return
@@ -1906,7 +3893,31 @@ async def list_scheduled_files(update: Update, context: CallbackContext) -> None
         else:
              message_parts.append(f"   ⏱️ *Last Run:* `Never`")
 
+    for rotation_name, rotation in sorted(user_rotations.items()):
+        if not isinstance(rotation, dict): continue
+        files = rotation.get('files', [])
+        interval_s = rotation.get('interval_seconds')
+        current_index = int(rotation.get('current_file_index') or 0) % len(files) if files else 0
+
+        message_parts.append(f"\n🔁 **Rotation:** `{escape(rotation.get('rotation_name', rotation_name))}` ({len(files)} file(s))")
+        if interval_s and isinstance(interval_s, int):
+            message_parts.append(f"   🔄 *Interval:* {format_time(interval_s)} per file, full cycle {format_time(interval_s * max(len(files), 1))}")
+        for number, entry in enumerate(files, start=1):
+            marker = "▶️" if number - 1 == current_index else "▫️"
+            source_name = entry.get('original_telegram_filename', 'N/A') if isinstance(entry, dict) else 'Invalid entry'
+            message_parts.append(f"   {marker} {number}. `{escape(source_name)}`")
+        next_run_iso = rotation.get('next_run_time_iso')
+        try:
+            next_run_dt = datetime.fromisoformat(next_run_iso.replace('Z', '+00:00'))
+            seconds_until = (next_run_dt - now_utc).total_seconds()
+            remaining_str = format_time(seconds_until) if seconds_until > 0 else "Due now or overdue"
+            message_parts.append(f"   ⏰ *Next Run:* {next_run_dt.strftime('%Y-%m-%d %H:%M UTC')} (`{remaining_str}`)")
+        except (ValueError, TypeError, AttributeError):
+            message_parts.append(f"   ⏰ *Next Run:* `Not Scheduled Yet / Error`")
+
     message_parts.append("\nUse `/removefile <ScheduleName.json>` to stop a schedule.")
+    if user_rotations:
+        message_parts.append("Use `/removerotationfile <RotationName> [FileNumber]` to remove a rotation or one of its files.")
 
     final_message = "\n".join(message_parts)
     if len(final_message) > 4096:
@@ -1993,7 +4004,7 @@ async def vip_management(update: Update, context: CallbackContext) -> None:
             })
             vip_data[target_user_id_str] = user_vip_info
 
-            if save_vip_data(vip_data):
+            if save_vip_data(vip_data, changed_users=[target_user_id_str]):
                 expiry_formatted_display = new_expiry_date.strftime('%Y-%m-%d %H:%M:%S UTC')
                 action_word = "Extended" if is_extending else "Added"
                 response_msg = f"✅ VIP {action_word} for User ID `{target_user_id}`.\nDuration Added: {days_to_add} days\nNew Expiry: `{expiry_formatted_display}`"
@@ -2076,7 +4087,7 @@ async def vip_management(update: Update, context: CallbackContext) -> None:
         was_vip = target_user_id_str in vip_data
         if was_vip:
             del vip_data[target_user_id_str]
-            if save_vip_data(vip_data):
+            if save_vip_data(vip_data, changed_users=[target_user_id_str]):
                 removed_vip = True
                 response_parts.append(f"✅ Successfully removed VIP status for `{target_user_id_str}`.")
                 logger.info(f"Admin {user.id} removed VIP for {target_user_id_str}.")
@@ -2092,7 +4103,7 @@ async def vip_management(update: Update, context: CallbackContext) -> None:
         was_github_config = target_user_id_str in github_configs
         if was_github_config:
             del github_configs[target_user_id_str]
-            if save_github_configs(github_configs):
+            if save_github_configs(github_configs, changed_users=[target_user_id_str]):
                 removed_github = True
                 response_parts.append(f"✅ Successfully removed associated GitHub config for `{target_user_id_str}`.")
                 logger.info(f"Removed GitHub config for {target_user_id_str} during VIP removal.")
@@ -2108,12 +4119,13 @@ async def vip_management(update: Update, context: CallbackContext) -> None:
             paths_to_delete = [info.get('stored_file_path') for info in user_schedules.values() if info.get('stored_file_path')]
 
             del schedules_data[target_user_id_str]
-            if save_scheduled_files(schedules_data):
+            if save_scheduled_files(schedules_data, changed_users=[target_user_id_str]):
                 removed_schedules = True
                 response_parts.append(f"✅ Successfully removed {len(schedule_names_to_remove)} scheduled file configuration(s) for `{target_user_id_str}`.")
                 logger.info(f"Removed {len(schedule_names_to_remove)} schedule configs for {target_user_id_str} during VIP removal.")
 
                 for file_path in paths_to_delete:
+                    schedule_checkpoint(file_path).discard()
                     if file_path and os.path.exists(file_path):
                         try:
                             os.remove(file_path)
@@ -2134,6 +4146,25 @@ async def vip_management(update: Update, context: CallbackContext) -> None:
                  response_parts.append(f"❌ Error saving schedule config data after attempting removal for `{target_user_id_str}`.")
                  logger.error(f"Failed to save schedule config data after removing for {target_user_id_str}.")
 
+        rotations_data = load_rotation_files()
+        user_rotations = rotations_data.get(target_user_id_str, {})
+        if user_rotations:
+            rotation_paths = [
+                resolve_stored_file_path(entry['stored_file_path'])
+                for rotation in user_rotations.values() if isinstance(rotation, dict)
+                for entry in rotation.get('files', []) if isinstance(entry, dict) and entry.get('stored_file_path')
+            ]
+            del rotations_data[target_user_id_str]
+            if save_rotation_files(rotations_data, changed_users=[target_user_id_str]):
+                removed_schedules = True
+                rotation_files_deleted = delete_rotation_file_data(rotation_paths)
+                response_parts.append(f"✅ Removed {len(user_rotations)} rotation schedule(s) and {rotation_files_deleted} of their stored file(s) for `{target_user_id_str}`.")
+                logger.info(f"Removed {len(user_rotations)} rotations for {target_user_id_str} during VIP removal.")
+            else:
+                 schedule_save_error = True
+                 response_parts.append(f"❌ Error saving rotation data after attempting removal for `{target_user_id_str}`.")
+                 logger.error(f"Failed to save rotation data after removing for {target_user_id_str}.")
+
         await message.reply_text("\n".join(response_parts) if response_parts else "No action taken or user not found.", parse_mode=ParseMode.MARKDOWN)
 
         if removed_vip:
@@ -2379,15 +4410,10 @@ async def broadcast(update: Update, context: CallbackContext) -> None:
 
     if users_to_remove:
         logger.info(f"Broadcast complete. Attempting to remove {removed_count} blocked/unreachable users from known list.")
-        current_known_users = load_known_users()
-        cleaned_users = current_known_users - users_to_remove
-        if save_known_users(cleaned_users):
-            final_user_count = len(cleaned_users)
-            save_status = f"✅ Removed {removed_count} inactive users ({final_user_count} remain)"
-            logger.info(f"Saved cleaned known_users file after broadcast. {final_user_count} users remain.")
-        else:
-            save_status = f"❌ Save FAILED! ({removed_count} were marked for removal)"
-            logger.error("Failed saving cleaned known_users file after broadcast.")
+        remove_known_users(users_to_remove)
+        final_user_count = len(load_known_users())
+        save_status = f"✅ Removed {removed_count} inactive users ({final_user_count} remain)"
+        logger.info(f"Queued removal of {removed_count} users from known_users journal after broadcast. {final_user_count} users remain.")
     else:
          save_status = f"✅ 0 users marked for removal ({total_users} remain)."
 
@@ -2416,6 +4442,32 @@ async def broadcast(update: Update, context: CallbackContext) -> None:
     else:
         await message.reply_text(final_text)
 
+async def api_status_command(update: Update, context: CallbackContext) -> None:
+    """Shows the current upstream API concurrency and health figures (admin only)."""
+    user = update.effective_user
+    message = update.message
+    if not user or not message or not ADMIN_ID or user.id != ADMIN_ID:
+        logger.warning(f"Unauthorized access attempt to /apistatus by user {user.id if user else 'Unknown'}")
+        if message: await message.reply_text("You are not authorized to use this command.")
+        return
+
+    p95 = api_concurrency.p95_latency()
+    status_parts = [
+        "📡 *Token API Status*\n",
+        f"⚙️ Concurrency Limit: `{api_limiter.limit}` (range {api_concurrency.min_limit}-{api_concurrency.max_limit})",
+        f"🔄 In Flight: `{api_limiter.active}` | ⏳ Waiting: `{api_limiter.waiting}`",
+        f"👥 Users With Active Calls: `{len(api_limiter.active_by_owner)}`",
+        f"⏱️ p95 Latency: `{f'{p95:.2f}s' if p95 is not None else 'N/A'}` (target {API_LATENCY_TARGET_P95:.0f}s)",
+        f"❌ Overload Rate: `{api_concurrency.error_rate() * 100:.1f}%` (last {len(api_concurrency.samples)} calls)",
+        f"🔌 Circuit: `{api_breaker.state}` (opened {api_breaker.times_opened} times)",
+        f"♻️ Token Cache: `{len(token_cache)}` entries | {token_cache.hits} hits / {token_cache.misses} misses",
+        f"🗂️ Manual Jobs: `{len(manual_jobs.running)}/{MAX_CONCURRENT_MANUAL_JOBS}` running | `{len(manual_jobs.pending)}` queued",
+        f"📅 Scheduled Runs In Progress: `{len(running_schedules)}`",
+    ]
+    if api_breaker.state == CircuitBreaker.OPEN:
+        status_parts.append(f"   Next probe in {format_time(api_breaker.seconds_until_probe())}")
+    await message.reply_text("\n".join(status_parts), parse_mode=ParseMode.MARKDOWN)
+
 # --- Message Forwarding (Handle non-command, non-button messages) ---
 async def forward_to_admin(update: Update, context: CallbackContext) -> None:
     """Forwards unhandled messages from non-admins in private chat to the admin."""
@@ -2462,11 +4514,12 @@ async def forward_to_admin(update: Update, context: CallbackContext) -> None:
 
 # --- Channel Leave Handler ---
 async def handle_member_left(update: Update, context: CallbackContext) -> None:
-    """Handles when a user leaves the required channel."""
+    """Handles channel member updates: refreshes the membership cache and notifies users who left."""
     if update.chat_member:
         chat = update.chat_member.chat
         if chat.username == CHANNEL_USERNAME:
             new_member = update.chat_member.new_chat_member
+            set_channel_membership(new_member.user.id, new_member.status in ['member', 'administrator', 'creator'])
             if new_member.status == 'left':
                 left_user = new_member.user
                 user_id = left_user.id
@@ -2588,143 +4641,305 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         except Exception as fallback_err:
             logger.critical(f"CRITICAL: Failed even the simplest error notification to admin. Check logs manually. Fallback error: {fallback_err}")
 
-# --- Background Task for Scheduled Processing ---
+# --- Background Task for VIP Expiry ---
 
-async def run_scheduled_file_processor(application: Application) -> None:
-    """Periodically checks for scheduled files and processes them."""
+async def run_vip_expiry_watcher(application: Application) -> None:
+    """Sleeps until the next VIP expiry and notifies users as soon as their VIP runs out."""
     bot = application.bot
-    logger.info(f"Background scheduler started. Check interval: {AUTO_PROCESS_CHECK_INTERVAL}s")
-    await asyncio.sleep(15)
-
+    logger.info("VIP expiry watcher started.")
     while True:
         try:
-            now_utc = datetime.now(timezone.utc)
-            logger.debug(f"Scheduler check running at {now_utc.isoformat()}")
-            schedules = load_scheduled_files()
-            if not schedules:
-                logger.debug("Scheduler: No schedules found.")
-                await asyncio.sleep(AUTO_PROCESS_CHECK_INTERVAL)
+            _vip_index_changed.clear()
+            next_expiry = next_vip_expiry()
+            sleep_for = VIP_EXPIRY_CHECK_MAX_SLEEP
+            if next_expiry is not None:
+                sleep_for = min(max(next_expiry - time.time(), 0), VIP_EXPIRY_CHECK_MAX_SLEEP)
+            try:
+                await asyncio.wait_for(_vip_index_changed.wait(), timeout=sleep_for)
                 continue
+            except asyncio.TimeoutError:
+                pass
 
-            tasks_to_run = []
+            expired_users = pop_expired_vips()
+            for user_id in expired_users:
+                logger.info(f"VIP expired for user {user_id}. Their GitHub uploads and scheduled files are now paused.")
+                try:
+                    await bot.send_message(
+                        user_id,
+                        "⏰ Your VIP membership has expired.\n"
+                        "GitHub auto-upload and scheduled file processing are paused until you renew.\n"
+                        "Use /vipshop to see the available plans."
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to notify user {user_id} about VIP expiry: {e}")
+            if expired_users:
+                mark_vip_expiry_notified(expired_users)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"VIP expiry watcher error: {e}", exc_info=True)
+            await asyncio.sleep(60)
 
-            github_configs = load_github_configs()
+# --- Background Task for Scheduled Processing ---
 
-            for user_id_str in list(schedules.keys()):
-                user_schedules = schedules.get(user_id_str)
-                if not isinstance(user_schedules, dict):
-                    logger.warning(f"Scheduler: Invalid schedule data format for user {user_id_str}. Skipping.")
-                    continue
+class DispatchBudget:
+    """
+    Token bucket of accounts that scheduled runs may start: per_window accounts, refilled
+    evenly over window seconds. A run bigger than the whole bucket waits until it is full
+    and then overdraws it, which holds back the runs after it by the same amount. Urgent
+    runs may start with up to `overdraft` accounts of debt, but no more.
+    """
 
-                try:
-                    user_id = int(user_id_str)
-                except ValueError:
-                    logger.warning(f"Scheduler: Invalid user ID key '{user_id_str}' in schedules. Skipping.")
-                    continue
+    def __init__(self, per_window: int, window: float):
+        self.capacity = per_window
+        self.rate = per_window / window
+        self.tokens = float(per_window)
+        self._updated = time.monotonic()
 
-                if not is_user_vip(user_id):
-                     logger.info(f"Scheduler: User {user_id} is no longer VIP. Skipping their schedules.")
-                     continue
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
 
-                if not await is_user_joined_channel(bot, user_id):
-                    logger.info(f"Scheduler: User {user_id} not joined to channel. Skipping schedules.")
-                    try:
-                        await bot.send_message(user_id, "⚠️ Your scheduled processings are skipped because you are not joined to the channel. Please rejoin https://t.me/atxnaughty to resume.")
-                    except Exception as e:
-                        logger.error(f"Failed to notify user {user_id} about skipped schedules: {e}")
-                    continue
+    def wait_time(self, accounts: int, overdraft: float = 0) -> float:
+        """Seconds until a run of this many accounts may start; 0 if it may start now."""
+        self._refill()
+        needed = min(accounts, self.capacity) - overdraft
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
 
-                user_github_config = github_configs.get(user_id_str)
+    def take(self, accounts: int) -> None:
+        self._refill()
+        self.tokens -= accounts
 
-                for schedule_name in list(user_schedules.keys()):
-                    schedule_info = user_schedules.get(schedule_name)
-                    if not isinstance(schedule_info, dict):
-                        logger.warning(f"Scheduler: Invalid schedule entry '{schedule_name}' for user {user_id}. Skipping.")
-                        continue
+schedule_dispatch_budget = DispatchBudget(SCHEDULE_ACCOUNTS_PER_WINDOW, SCHEDULE_DISPATCH_WINDOW)
 
-                    next_run_iso = schedule_info.get('next_run_time_iso')
-                    stored_file_path = schedule_info.get('stored_file_path')
-                    interval_seconds = schedule_info.get('interval_seconds')
+def schedule_account_count(schedule_info: dict) -> int:
+    """
+    Number of accounts in a schedule's stored file. Recorded by /setfile; for schedules
+    created before that, the file is counted once and the result kept in the schedule.
+    """
+    account_count = schedule_info.get('account_count')
+    if isinstance(account_count, int):
+        return account_count
+    account_count = 0
+    try:
+        with open(schedule_info['stored_file_path'], 'r', encoding='utf-8') as stored_file:
+            for _ in iter_json_array(stored_file):
+                account_count += 1
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Scheduler: Could not count accounts in {schedule_info.get('stored_file_path')}: {e}")
+        return account_count
+    schedule_info['account_count'] = account_count
+    return account_count
+
+def schedule_lateness_ratio(schedule_info: dict) -> float:
+    """
+    How late a due schedule is, as a fraction of its interval (0 if on time or unknown). Time
+    before the scheduler started doesn't count, so runs that fell due during downtime aren't
+    all urgent at once after a restart.
+    """
+    try:
+        next_run_dt = datetime.fromisoformat(schedule_info['next_run_time_iso'].replace('Z', '+00:00'))
+        late_since = max(next_run_dt.timestamp(), scheduler_started_at)
+        return max(0.0, (time.time() - late_since) / schedule_info['interval_seconds'])
+    except (KeyError, ValueError, TypeError, AttributeError, ZeroDivisionError):
+        return 0.0
+
+# Scheduled runs in progress, keyed by (user_id_str, schedule_name). Each due schedule runs
+# as its own task, so a large file doesn't hold back other users' schedules, and a schedule
+# that is still running when it comes due again is not started a second time.
+running_schedules: dict[tuple[str, str], asyncio.Task] = {}
+scheduler_started_at = 0.0  # Epoch time the scheduler started; lateness is measured from here at the earliest
+
+def advance_schedule_next_run(user_id_str: str, schedule_name: str, next_file: bool = True) -> None:
+    """
+    Records a completed run and moves the schedule's next run one interval past now.
+    For a rotation this also moves on to its next file, unless next_file is False
+    (the run was skipped, so the same file is tried again next time).
+    """
+    is_rotation = schedule_name.startswith(ROTATION_KEY_PREFIX)
+    current_schedules = load_rotation_files() if is_rotation else load_scheduled_files()
+    entry_name = schedule_name[len(ROTATION_KEY_PREFIX):] if is_rotation else schedule_name
+    try:
+        if user_id_str in current_schedules and entry_name in current_schedules[user_id_str]:
+            info = current_schedules[user_id_str][entry_name]
+            interval_s = info.get('interval_seconds')
+            if interval_s and isinstance(interval_s, int) and interval_s > 0:
+                last_run_time = datetime.now(timezone.utc)
+                next_run_time = last_run_time + timedelta(seconds=interval_s)
+                info['last_run_time_iso'] = last_run_time.isoformat()
+                info['next_run_time_iso'] = next_run_time.isoformat()
+                if is_rotation and next_file and info.get('files'):
+                    info['current_file_index'] = (int(info.get('current_file_index') or 0) + 1) % len(info['files'])
+                set_schedule_deadline(user_id_str, schedule_name, next_run_time.timestamp() + schedule_jitter(user_id_str, schedule_name, interval_s))
+                save_schedules = save_rotation_files if is_rotation else save_scheduled_files
+                if not save_schedules(current_schedules, reindex=False, changed_users=[user_id_str]):
+                    logger.error("Scheduler: CRITICAL - Failed to save updated schedule run times!")
+                logger.info(f"Scheduler: Updated next run time for '{schedule_name}' (User {user_id_str}) to {next_run_time.isoformat()}")
+            else:
+                 logger.error(f"Scheduler: Cannot update next run for '{schedule_name}' (User {user_id_str}) - missing or invalid interval.")
+        else:
+             logger.info(f"Scheduler: Schedule '{schedule_name}' for user {user_id_str} was removed before run time update.")
+    except Exception as update_err:
+        logger.error(f"Scheduler: Error updating schedule info for User {user_id_str}, Schedule {schedule_name}: {update_err}", exc_info=True)
 
-                    if not next_run_iso or not stored_file_path or not interval_seconds:
-                        logger.warning(f"Scheduler: Skipping invalid schedule '{schedule_name}' for user {user_id} (missing essential info).")
-                        continue
+async def run_schedule_task(bot, user_id: int, schedule_name: str, schedule_info: dict, github_config: dict | None) -> None:
+    """Runs one due schedule, then advances its next run time. Registered in running_schedules while it runs."""
+    schedule_key = (str(user_id), schedule_name)
+    try:
+        res_user_id_str, res_schedule_name, _, processed = await process_single_schedule(bot, user_id, schedule_name, schedule_info, github_config)
+        advance_schedule_next_run(res_user_id_str, res_schedule_name, next_file=processed)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Scheduler: Error result returned from scheduled task processing: {e}", exc_info=True)
+        set_schedule_deadline(*schedule_key, time.time() + AUTO_PROCESS_CHECK_INTERVAL)
+    finally:
+        running_schedules.pop(schedule_key, None)
 
-                    try:
-                        next_run_dt = datetime.fromisoformat(next_run_iso.replace('Z', '+00:00'))
-                    except (ValueError, TypeError):
-                        logger.warning(f"Scheduler: Skipping schedule '{schedule_name}' for user {user_id} due to invalid next_run_time_iso: {next_run_iso}")
-                        continue
+async def run_scheduled_file_processor(application: Application) -> None:
+    """Sleeps until the next schedule is due and starts due schedules as independent tasks."""
+    global scheduler_started_at
+    bot = application.bot
+    scheduler_started_at = time.time()
+    logger.info("Background scheduler started.")
+    try:
+        await asyncio.sleep(15)
+        await _scheduler_loop(bot)
+    finally:
+        in_flight = list(running_schedules.values())
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            logger.info(f"Scheduler: Cancelling {len(in_flight)} running schedule(s); they resume from their checkpoints.")
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+async def _scheduler_loop(bot) -> None:
+    while True:
+        try:
+            _schedule_index_changed.clear()
+            next_due = next_schedule_deadline()
+            sleep_for = SCHEDULER_MAX_SLEEP
+            if next_due is not None:
+                sleep_for = min(max(next_due - time.time(), 0), SCHEDULER_MAX_SLEEP)
+            try:
+                await asyncio.wait_for(_schedule_index_changed.wait(), timeout=sleep_for)
+                continue
+            except asyncio.TimeoutError:
+                pass
 
-                    if next_run_dt <= now_utc:
-                        logger.info(f"Scheduler: Schedule '{schedule_name}' for user {user_id} is due. Preparing task.")
-                        if os.path.exists(stored_file_path):
-                            tasks_to_run.append(
-                                process_single_schedule(
-                                    bot, user_id, schedule_name, schedule_info, user_github_config
-                                )
-                            )
-                        else:
-                            logger.error(f"Scheduler: Stored file missing for due schedule '{schedule_name}' user {user_id} at path {stored_file_path}. Skipping run and notifying user.")
-                            try:
-                                await bot.send_message(
-                                    user_id,
-                                    f"⚠️ Error: Could not run scheduled task `'{escape(schedule_info.get('user_schedule_name', schedule_name))}'`. The associated data file seems to be missing. Please use `/setfile` again for this schedule.",
-                                    parse_mode=ParseMode.MARKDOWN
-                                )
-                            except Exception as notify_err:
-                                logger.error(f"Scheduler: Failed to notify user {user_id} about missing schedule file: {notify_err}")
-
-            if tasks_to_run:
-                logger.info(f"Scheduler: Running {len(tasks_to_run)} due schedule(s).")
-                results = await asyncio.gather(*tasks_to_run, return_exceptions=True)
-
-                current_schedules = load_scheduled_files()
-                made_changes = False
-                for result in results:
-                     if isinstance(result, tuple) and len(result) == 3:
-                        res_user_id_str, res_schedule_name, _ = result
-                        try:
-                            if res_user_id_str in current_schedules and res_schedule_name in current_schedules[res_user_id_str]:
-                                info = current_schedules[res_user_id_str][res_schedule_name]
-                                interval_s = info.get('interval_seconds')
-                                if interval_s and isinstance(interval_s, int) and interval_s > 0:
-                                    last_run_time = datetime.now(timezone.utc)
-                                    next_run_time = last_run_time + timedelta(seconds=interval_s)
-                                    current_schedules[res_user_id_str][res_schedule_name]['last_run_time_iso'] = last_run_time.isoformat()
-                                    current_schedules[res_user_id_str][res_schedule_name]['next_run_time_iso'] = next_run_time.isoformat()
-                                    made_changes = True
-                                    logger.info(f"Scheduler: Updated next run time for '{res_schedule_name}' (User {res_user_id_str}) to {next_run_time.isoformat()}")
-                                else:
-                                     logger.error(f"Scheduler: Cannot update next run for '{res_schedule_name}' (User {res_user_id_str}) - missing or invalid interval.")
-                            else:
-                                 logger.info(f"Scheduler: Schedule '{res_schedule_name}' for user {res_user_id_str} was removed before run time update.")
-                        except Exception as update_err:
-                            logger.error(f"Scheduler: Error updating schedule info for User {res_user_id_str}, Schedule {res_schedule_name}: {update_err}", exc_info=True)
-
-                     elif isinstance(result, Exception):
-                         logger.error(f"Scheduler: Error result returned from scheduled task processing: {result}", exc_info=result)
-
-                if made_changes:
-                    if not save_scheduled_files(current_schedules):
-                        logger.error("Scheduler: CRITICAL - Failed to save updated schedule run times!")
+            due_schedules = pop_due_schedules()
+            if not due_schedules:
+                continue
 
-            else:
-                logger.debug("Scheduler: No schedules were due this cycle.")
+            launched_count = await start_due_schedules(bot, due_schedules)
+            if launched_count:
+                logger.info(f"Scheduler: Started {launched_count} due schedule(s). {len(running_schedules)} running in total.")
 
+        except asyncio.CancelledError:
+            raise
         except Exception as loop_err:
             logger.critical(f"Scheduler: Unhandled exception in main processing loop: {loop_err}", exc_info=True)
             await asyncio.sleep(60)
 
-        await asyncio.sleep(AUTO_PROCESS_CHECK_INTERVAL)
+async def start_due_schedules(bot, due_schedules: list[tuple[str, str]]) -> int:
+    """
+    Starts a task for each due schedule that can run. Schedules that can't run now are
+    left out of the index until something changes (VIP renewed, /setfile again), except
+    for users who left the channel, who are retried after AUTO_PROCESS_CHECK_INTERVAL.
+    Runs that aren't urgent yet are pushed back while calls are queueing for the token API
+    or schedule_dispatch_budget has no room for their accounts; urgent runs only once the
+    budget is a full window in debt. Returns how many tasks were started.
+    """
+    schedules = load_scheduled_files()
+    rotations = load_rotation_files()
+    github_configs = load_github_configs()
+    channel_checks: dict[int, bool] = {}
+    launched_count = 0
+
+    for user_id_str, schedule_name in due_schedules:
+        schedule_key = (user_id_str, schedule_name)
+        if schedule_name.startswith(ROTATION_KEY_PREFIX):
+            rotation_name = schedule_name[len(ROTATION_KEY_PREFIX):]
+            schedule_info = rotation_tick_info(rotation_name, rotations.get(user_id_str, {}).get(rotation_name))
+        else:
+            schedule_info = schedules.get(user_id_str, {}).get(schedule_name)
+        if not isinstance(schedule_info, dict):
+            logger.warning(f"Scheduler: Invalid schedule entry '{schedule_name}' for user {user_id_str}. Skipping.")
+            continue
+
+        try:
+            user_id = int(user_id_str)
+        except ValueError:
+            logger.warning(f"Scheduler: Invalid user ID key '{user_id_str}' in schedules. Skipping.")
+            continue
+
+        if not is_user_vip(user_id):
+             logger.info(f"Scheduler: User {user_id} is no longer VIP. Skipping schedule '{schedule_name}'.")
+             continue
+
+        if user_id not in channel_checks:
+            channel_checks[user_id] = await is_user_joined_channel(bot, user_id)
+            if not channel_checks[user_id]:
+                logger.info(f"Scheduler: User {user_id} not joined to channel. Skipping schedules.")
+                try:
+                    await bot.send_message(user_id, "⚠️ Your scheduled processings are skipped because you are not joined to the channel. Please rejoin https://t.me/atxnaughty to resume.")
+                except Exception as e:
+                    logger.error(f"Failed to notify user {user_id} about skipped schedules: {e}")
+        if not channel_checks[user_id]:
+            set_schedule_deadline(user_id_str, schedule_name, time.time() + AUTO_PROCESS_CHECK_INTERVAL)
+            continue
+
+        stored_file_path = resolve_stored_file_path(schedule_info.get('stored_file_path'))
+        if not stored_file_path or not schedule_info.get('interval_seconds'):
+            logger.warning(f"Scheduler: Skipping invalid schedule '{schedule_name}' for user {user_id} (missing essential info).")
+            continue
+
+        if schedule_key in running_schedules:
+            logger.debug(f"Scheduler: Schedule '{schedule_name}' for user {user_id} is due but its previous run is still going. It is rescheduled when that run finishes.")
+            continue
+
+        if not os.path.exists(stored_file_path):
+            logger.error(f"Scheduler: Stored file missing for due schedule '{schedule_name}' user {user_id} at path {stored_file_path}. Skipping run and notifying user.")
+            try:
+                await bot.send_message(
+                    user_id,
+                    f"⚠️ Error: Could not run scheduled task `'{escape(schedule_info.get('user_schedule_name', schedule_name))}'`. The associated data file seems to be missing. "
+                    + ("Please remove it with `/removerotationfile` and add it again." if schedule_name.startswith(ROTATION_KEY_PREFIX) else "Please use `/setfile` again for this schedule."),
+                    parse_mode=ParseMode.MARKDOWN
+                )
+            except Exception as notify_err:
+                logger.error(f"Scheduler: Failed to notify user {user_id} about missing schedule file: {notify_err}")
+            continue
+
+        account_count = schedule_account_count(schedule_info)
+        lateness = schedule_lateness_ratio(schedule_info)
+        if lateness < SCHEDULE_MAX_DEFER_RATIO:
+            defer_for = SCHEDULE_DEFER_DELAY if api_limiter.waiting else schedule_dispatch_budget.wait_time(account_count)
+        else:
+            # Urgent: no waiting on queued calls, and the budget may be overdrawn by one window, but no further.
+            defer_for = schedule_dispatch_budget.wait_time(account_count, overdraft=schedule_dispatch_budget.capacity)
+        if defer_for > 0:
+            logger.info(f"Scheduler: Deferring schedule '{schedule_name}' for user {user_id} ({account_count} accounts) by {defer_for:.0f}s to spread upstream load.")
+            set_schedule_deadline(user_id_str, schedule_name, time.time() + defer_for)
+            continue
+        schedule_dispatch_budget.take(account_count)
+
+        logger.info(f"Scheduler: Schedule '{schedule_name}' for user {user_id} is due ({account_count} accounts, {lateness * 100:.0f}% of interval late). Starting task.")
+        running_schedules[schedule_key] = asyncio.create_task(
+            run_schedule_task(bot, user_id, schedule_name, schedule_info, github_configs.get(user_id_str))
+        )
+        launched_count += 1
+    return launched_count
 
-async def process_single_schedule(bot, user_id: int, schedule_name: str, schedule_info: dict, github_config: dict | None) -> tuple[str, str, bool]:
+async def process_single_schedule(bot, user_id: int, schedule_name: str, schedule_info: dict, github_config: dict | None) -> tuple[str, str, bool, bool]:
     """
     Processes a single scheduled file: reads data, calls API, uploads to GitHub.
-    Returns (user_id_str, schedule_name, github_upload_success_or_skipped)
+    Returns (user_id_str, schedule_name, github_upload_success_or_skipped, processed),
+    where processed is False if the run was skipped without touching the file.
     """
     user_id_str = str(user_id)
-    stored_file_path = schedule_info.get('stored_file_path')
+    stored_file_path = resolve_stored_file_path(schedule_info.get('stored_file_path'))
     user_display_name = schedule_info.get('user_schedule_name', schedule_name)
     github_upload_status = False
 
@@ -2738,11 +4953,12 @@ async def process_single_schedule(bot, user_id: int, schedule_name: str, schedul
     except Exception as e:
         logger.error(f"{log_prefix} Failed to send initial status DM: {e}")
 
-    accounts_data = []
     run_timestamp = int(time.time())
     temp_results_dir = os.path.join(TEMP_DIR, f"auto_{user_id}_{schedule_name}_{run_timestamp}")
     cleanup_paths_auto = [temp_results_dir]
     jwt_token_path_for_upload = None
+    checkpoint = schedule_checkpoint(stored_file_path or schedule_name)
+    keep_checkpoint = False
 
     try:
         if not stored_file_path or not os.path.exists(stored_file_path):
@@ -2750,72 +4966,108 @@ async def process_single_schedule(bot, user_id: int, schedule_name: str, schedul
 
         await update_schedule_status(bot, status_msg_obj, notify_parts, "Reading stored file...")
 
-        with open(stored_file_path, 'r', encoding='utf-8') as f:
+        with open(stored_file_path, 'r', encoding='utf-8') as stored_file:
+            account_stream = iter_json_array(stored_file)
             try:
-                accounts_data = json.load(f)
-                if not isinstance(accounts_data, list):
-                    raise ValueError("JSON content must be an array (list).")
-                if accounts_data and not all(isinstance(item, dict) for item in accounts_data):
-                     first_bad = next((x for x in accounts_data if not isinstance(x, dict)), None)
-                     raise ValueError(f"All items in the list must be JSON objects (`{{...}}`). Found: {type(first_bad)}")
-                logger.info(f"{log_prefix} Read {len(accounts_data)} accounts from {stored_file_path}")
+                first_account = next(account_stream, None)
             except json.JSONDecodeError as e:
                 raise ValueError(f"Invalid JSON format in stored file: {e.msg} (Line: {e.lineno}, Col: {e.colno})")
-            except ValueError as ve:
-                 raise ve
-            except Exception as read_err:
-                 raise IOError(f"Could not read or validate the downloaded file: {read_err}")
-
-        total_count = len(accounts_data)
-        if total_count == 0:
-            logger.info(f"{log_prefix} Stored file is empty. No processing needed.")
-            await update_schedule_status(bot, status_msg_obj, notify_parts, "✅ Finished: Stored file was empty.")
-            return user_id_str, schedule_name, True
-
-        await update_schedule_status(bot, status_msg_obj, notify_parts, f"Processing {total_count} accounts via API...")
-
-        start_time = time.time()
-        successful_tokens = []
-        lost_accounts = []
-        errors_summary = defaultdict(int)
-        successful_by_region = defaultdict(list)
-        working_by_region = defaultdict(list)
-        processed_count = 0
-
-        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-        async with aiohttp.ClientSession() as session:
-            tasks = [process_account(session, account, semaphore) for account in accounts_data]
-
-            for i, future in enumerate(asyncio.as_completed(tasks)):
-                update_freq_auto = max(5, min(50, total_count // 10))
-                if status_msg_obj and (i + 1) % update_freq_auto == 0:
-                     progress_pct = ((i + 1) / total_count) * 100
-                     await update_schedule_status(bot, status_msg_obj, notify_parts, f"Processing API... {i+1}/{total_count} ({progress_pct:.0f}%)", keep_last=False)
+            if first_account is not None and not isinstance(first_account, dict):
+                raise ValueError(f"All items in the list must be JSON objects (`{{...}}`). Found: {type(first_account)}")
+
+            if first_account is None:
+                logger.info(f"{log_prefix} Stored file is empty. No processing needed.")
+                await update_schedule_status(bot, status_msg_obj, notify_parts, "✅ Finished: Stored file was empty.")
+                return user_id_str, schedule_name, True, True
+
+            if api_breaker.rejecting():
+                logger.warning(f"{log_prefix} Token API circuit is open. Skipping this run.")
+                keep_checkpoint = True
+                await update_schedule_status(bot, status_msg_obj, notify_parts, "⏸️ Skipped: the token API is currently unavailable. Will try again at the next scheduled run.", is_final=True)
+                return user_id_str, schedule_name, False, False
+
+            # The checkpoint holds either a run cut short by a restart (resumed as is) or the
+            # previous finished run (incremental: only tokens that outlive the next run are
+            # reused). Either way it is only used if the stored file hasn't changed since.
+            stored_stat = os.stat(stored_file_path)
+            input_signature = [stored_stat.st_size, stored_stat.st_mtime_ns]
+            checkpoint_meta = checkpoint.load_meta()
+            if checkpoint_meta and checkpoint_meta.get('input_signature') == input_signature:
+                previous_run_finished = checkpoint_meta.get('state') == 'complete'
+                if previous_run_finished:
+                    interval_seconds = schedule_info.get('interval_seconds') or 0
+                    restorable_count = checkpoint.load_results(incremental_min_remaining=interval_seconds + TOKEN_CACHE_MIN_REMAINING)
+                    if restorable_count:
+                        logger.info(f"{log_prefix} Incremental run; reusing {restorable_count} still-valid tokens from the previous run.")
+                        notify_parts.append(f"♻️ Incremental run: {restorable_count} still-valid tokens reused, only expiring or failed accounts are refreshed.")
+                else:
+                    restorable_count = checkpoint.load_results()
+                    if restorable_count:
+                        logger.info(f"{log_prefix} Resuming interrupted run; {restorable_count} results restored from checkpoint.")
+                        notify_parts.append(f"💾 Resuming an interrupted run ({restorable_count} accounts already done).")
+            else:
+                checkpoint.discard()
+                checkpoint_meta = {"kind": "schedule", "user_id": user_id, "schedule_name": schedule_name, "input_signature": input_signature}
+            checkpoint_meta.update(state='running', started_at=time.time())
+            checkpoint.save_meta(checkpoint_meta)
+
+            await update_schedule_status(bot, status_msg_obj, notify_parts, "Processing accounts via API...")
+
+            start_time = time.time()
+            successful_tokens = []
+            lost_count = 0
+            errors_summary = defaultdict(int)
+            processed_count = 0
+
+            session = get_http_session(API_BASE_URL)
+            retry_budget = RetryBudget()
+            deduplicator = AccountDeduplicator()
+            pool = AccountWorkerPool(session, user_id, retry_budget)
+            account_stream = (item for item in itertools.chain((first_account,), account_stream)
+                              if not isinstance(item, dict) or deduplicator.admit(item))
+            pool_results = pool.results(checkpoint.indexed_items(account_stream))
 
-                try:
-                    token, region, working_acc, lost_acc, error_reason = await future
+            try:
+                async for result in pool_results:
                     processed_count += 1
-                    if token and working_acc:
-                        region_name = region if region else "Unknown"
-                        successful_tokens.append({"token": token, "region": region_name})
-                        successful_by_region[region_name].append({"token": token})
-                        working_by_region[region_name].append(working_acc)
-                    elif lost_acc:
-                        lost_accounts.append(lost_acc)
-                        reason = lost_acc.get("error_reason", "Unknown")
-                        errors_summary[reason.split(':')[0].strip()] += 1
+                    checkpoint.record(result)
+                    if result.token:
+                        successful_tokens.append(result.token)
                     else:
-                         lost_accounts.append({"account_info": "unknown", "error_reason": "Unexpected process_account result"})
-                         errors_summary["Processing function error"] += 1
-                except Exception as task_err:
-                    processed_count += 1
-                    logger.error(f"{log_prefix} Error retrieving result from API task: {task_err}", exc_info=True)
-                    lost_accounts.append({"account_info": "unknown", "error_reason": f"Task Error: {task_err}"})
-                    errors_summary["Internal task error"] += 1
+                        lost_count += 1
+                        reason = result.error_reason or "Unknown"
+                        errors_summary[reason.split(':')[0].strip()] += 1
+
+                    update_freq_auto = max(5, min(50, pool.submitted // 10))
+                    if status_msg_obj and processed_count % update_freq_auto == 0:
+                        if pool.input_done:
+                            progress_pct = (processed_count / pool.submitted) * 100
+                            progress_status = f"Processing API... {processed_count}/{pool.submitted} ({progress_pct:.0f}%)"
+                        else:
+                            progress_status = f"Processing API... {processed_count}/{pool.submitted}+"
+                        await update_schedule_status(bot, status_msg_obj, notify_parts, progress_status, keep_last=False)
+            finally:
+                await pool_results.aclose()
+                checkpoint.close()
+
+        if SCHEDULE_INCREMENTAL_RUNS and checkpoint.compact():
+            checkpoint_meta['state'] = 'complete'
+            keep_checkpoint = checkpoint.save_meta(checkpoint_meta)
+
+        duplicates_removed, conflicting_uids = deduplicator.duplicates_removed, deduplicator.conflicting_uids
+        if duplicates_removed or conflicting_uids:
+            logger.info(f"{log_prefix} Removed {duplicates_removed} duplicate accounts, {len(conflicting_uids)} UIDs with conflicting passwords.")
+            notify_parts.append(f"♻️ {duplicates_removed} duplicate accounts skipped, {len(conflicting_uids)} UIDs with conflicting passwords.")
+        if pool.input_error:
+            notify_parts.append(f"⚠️ Stored file is malformed after {pool.submitted} items; the rest was skipped: `{escape(str(getattr(pool.input_error, 'msg', pool.input_error)))}`")
 
         processing_time = time.time() - start_time
-        logger.info(f"{log_prefix} API processing finished in {processing_time:.2f}s. Success: {len(successful_tokens)}, Failed: {len(lost_accounts)}")
-        notify_parts.append(f"📊 API Results: {len(successful_tokens)} tokens generated, {len(lost_accounts)} failures.")
+        logger.info(f"{log_prefix} API processing finished in {processing_time:.2f}s. Success: {len(successful_tokens)}, Failed: {lost_count}, Retries: {retry_budget.retries_used}")
+        notify_parts.append(f"📊 API Results: {len(successful_tokens)} tokens generated, {lost_count} failures.")
+        if retry_budget.retried_successes:
+            notify_parts.append(f"   (🔁 {retry_budget.retried_successes} succeeded after retry)")
+        if errors_summary.get(UPSTREAM_UNAVAILABLE_REASON):
+            notify_parts.append(f"⚠️ Token API went down during this run; {errors_summary[UPSTREAM_UNAVAILABLE_REASON]} accounts were skipped.")
         if errors_summary:
              top_errors = sorted(errors_summary.items(), key=lambda item: item[1], reverse=True)
              error_snippets = []
@@ -2823,11 +5075,21 @@ async def process_single_schedule(bot, user_id: int, schedule_name: str, schedul
                  error_snippets.append(f"`{escape(err_msg)}` ({count})")
              notify_parts.append(f"   (Top errors: {'; '.join(error_snippets)})")
 
+        latest_tokens_path = schedule_info.get('latest_tokens_path')
+        if latest_tokens_path:
+            # Rotation tick: keep this file's tokens (unless the run produced none, e.g. the API
+            # was down) and upload the latest tokens of every file in the rotation.
+            if successful_tokens and not save_json_data(latest_tokens_path, successful_tokens):
+                logger.error(f"{log_prefix} Could not save rotation tokens to {latest_tokens_path}.")
+            rotation_tokens_paths = schedule_info.get('rotation_tokens_paths', [])
+            successful_tokens = merge_rotation_tokens(rotation_tokens_paths)
+            notify_parts.append(f"🔁 Rotation: {len(successful_tokens)} tokens merged from {len(rotation_tokens_paths)} file(s) for upload.")
+
         if successful_tokens:
             await update_schedule_status(bot, status_msg_obj, notify_parts, "Preparing token file for upload...")
             os.makedirs(temp_results_dir, exist_ok=True)
             jwt_token_path_for_upload = os.path.join(temp_results_dir, 'all_server_token_auto.json')
-            tokens_only_list = [{"token": entry["token"]} for entry in successful_tokens if entry.get("token")]
+            tokens_only_list = [{"token": token} for token in successful_tokens]
             if tokens_only_list:
                 if not save_json_data(jwt_token_path_for_upload, tokens_only_list):
                     jwt_token_path_for_upload = None
@@ -2865,6 +5127,9 @@ async def process_single_schedule(bot, user_id: int, schedule_name: str, schedul
 
         final_success_state = github_upload_status or (not jwt_token_path_for_upload)
 
+    except asyncio.CancelledError:
+        keep_checkpoint = True  # Shutting down: the next run after startup resumes from the checkpoint
+        raise
     except Exception as e:
         logger.error(f"{log_prefix} FAILED: {e}", exc_info=True)
         final_success_state = False
@@ -2878,6 +5143,8 @@ async def process_single_schedule(bot, user_id: int, schedule_name: str, schedul
             logger.error(f"{log_prefix} Could not notify user about processing failure: {notify_err}")
 
     finally:
+        if not keep_checkpoint:
+            checkpoint.discard()
         for path in cleanup_paths_auto:
             if os.path.exists(path):
                 try:
@@ -2889,7 +5156,7 @@ async def process_single_schedule(bot, user_id: int, schedule_name: str, schedul
                 except OSError as e:
                     logger.warning(f"{log_prefix} Could not clean up temp path {path}: {e}")
 
-    return user_id_str, schedule_name, final_success_state
+    return user_id_str, schedule_name, final_success_state, True
 
 async def update_schedule_status(bot, status_msg_obj, notify_parts: list, new_status: str, keep_last=True, is_final=False):
     """Helper to update the status message sent to the user during auto-processing."""
@@ -2961,6 +5228,7 @@ async def main() -> None:
         os.makedirs(DATA_DIR, exist_ok=True)
         os.makedirs(TEMP_DIR, exist_ok=True)
         os.makedirs(SCHEDULED_FILES_DATA_DIR, exist_ok=True)
+        os.makedirs(JOBS_DIR, exist_ok=True)
         logger.info(f"Data Directory: {DATA_DIR}")
         logger.info(f"Temp Directory: {TEMP_DIR}")
         logger.info(f"Scheduled Files Storage: {SCHEDULED_FILES_DATA_DIR}")
@@ -2968,6 +5236,13 @@ async def main() -> None:
         print(f"\nFATAL ERROR: Cannot create required directories: {e}\n-> Exiting.")
         exit(1)
 
+    try:
+        init_storage()
+    except (sqlite3.Error, OSError) as e:
+        print(f"\nFATAL ERROR: Cannot open {STORAGE_BACKEND} storage backend: {e}\n-> Exiting.")
+        exit(1)
+    preload_state()
+
     app_builder = Application.builder().token(TOKEN)\
         .concurrent_updates(True) \
         .read_timeout(30) \
@@ -2996,6 +5271,8 @@ async def main() -> None:
 
     application.add_handler(CommandHandler("setfile", set_scheduled_file_start, filters=private_chat_filter))
     application.add_handler(CommandHandler("removefile", remove_scheduled_file, filters=private_chat_filter))
+    application.add_handler(CommandHandler("addrotationfile", add_rotation_file_start, filters=private_chat_filter))
+    application.add_handler(CommandHandler("removerotationfile", remove_rotation_file, filters=private_chat_filter))
     application.add_handler(CommandHandler("scheduledfiles", list_scheduled_files, filters=private_chat_filter))
     application.add_handler(MessageHandler(filters.Regex(f"^{re.escape(COMMAND_BUTTONS_LAYOUT[2][0])}$") & private_chat_filter, list_scheduled_files))
 
@@ -3012,7 +5289,8 @@ async def main() -> None:
         admin_filter = filters.User(user_id=ADMIN_ID) & private_chat_filter
         application.add_handler(CommandHandler("vip", vip_management, filters=admin_filter))
         application.add_handler(CommandHandler("broadcast", broadcast, filters=admin_filter))
-        logger.info(f"Admin commands (/vip, /broadcast) enabled for ADMIN_ID: {ADMIN_ID}.")
+        application.add_handler(CommandHandler("apistatus", api_status_command, filters=admin_filter))
+        logger.info(f"Admin commands (/vip, /broadcast, /apistatus) enabled for ADMIN_ID: {ADMIN_ID}.")
     else:
          logger.warning("Admin commands are disabled as ADMIN_ID is not set, 0, or invalid.")
 
@@ -3032,8 +5310,8 @@ async def main() -> None:
     else:
         logger.warning("Message forwarding to admin is disabled as ADMIN_ID is not set or invalid.")
 
-    # Add handler for channel leave
-    application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, handle_member_left))
+    # Add handler for channel member updates (joins/leaves keep the membership cache current)
+    application.add_handler(ChatMemberHandler(handle_member_left, ChatMemberHandler.CHAT_MEMBER))
 
     application.add_error_handler(error_handler)
 
@@ -3048,10 +5326,22 @@ async def main() -> None:
         print(f" ✔️ Bot Username: @{bot_info.username} (ID: {bot_info.id})")
         print(f" ✔️ Admin ID: {ADMIN_ID if (ADMIN_ID and ADMIN_ID != 0) else 'Not Set (Admin Features Disabled)'}")
         print(f" ✔️ Data Directory: {DATA_DIR}")
-        print(f" ✔️ Scheduled File Check Interval: {AUTO_PROCESS_CHECK_INTERVAL}s")
+        next_due = next_schedule_deadline()
+        print(f" ✔️ Scheduled Files: {len(_schedule_deadlines)} (next run {datetime.fromtimestamp(next_due, timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC') if next_due else 'N/A'})")
+
+        get_http_session(API_BASE_URL)
+        get_http_session(GITHUB_API_URL)
 
         scheduler_task = asyncio.create_task(run_scheduled_file_processor(application))
         logger.info("Background scheduler task created.")
+        background_tasks = [
+            asyncio.create_task(run_state_flusher()),
+            asyncio.create_task(run_vip_expiry_watcher(application)),
+        ]
+        background_tasks += [asyncio.create_task(run_manual_job_worker(application)) for _ in range(MAX_CONCURRENT_MANUAL_JOBS)]
+        resumed_jobs = await resume_checkpointed_jobs(application.bot)
+        if resumed_jobs:
+            print(f" ✔️ Resumed {resumed_jobs} interrupted manual job(s)")
 
         await application.start()
         await application.updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
@@ -3094,6 +5384,17 @@ async def main() -> None:
                    logger.info("Scheduler task cancelled successfully.")
               except Exception as task_err:
                   logger.error(f"Error during scheduler task cancellation/await: {task_err}")
+         for task in locals().get('background_tasks', []):
+              if not task.done():
+                   task.cancel()
+                   try:
+                        await task
+                   except asyncio.CancelledError:
+                        pass
+         await close_http_sessions()
+         if not flush_state():
+              logger.error("Final state flush failed. Some recent changes may not have been saved.")
+         close_storage()
          logger.info("Shutdown complete.")
 
 if __name__ == '__main__':